@@ -1,15 +1,48 @@
 import os
 import sys
 import logging
-from flask import Flask, render_template, request, jsonify, send_from_directory
-from datetime import datetime, timedelta
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, stream_with_context
+from datetime import datetime, timezone
 from flask_mail import Mail, Message
 from flask_wtf.csrf import CSRFProtect, generate_csrf
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from itsdangerous import BadSignature, URLSafeSerializer
 import json
-import pandas as pd
+import atexit
+import click
+import fcntl
+import glob
+import multiprocessing
+import threading
+import time
+import zipfile
 import numpy as np
+from collections import namedtuple
+from itertools import chain, islice
+from concurrent.futures import ProcessPoolExecutor
+from visa_store import (
+    ArrayStore, BloomFilter, FilteredStore, SQLiteStore, diff_databases, lookup_statuses, read_snapshot,
+    snapshot_path_for, write_snapshot,
+)
+from visa_ingest import build_visa_store, compile_visa_database
+from email_outbox import (
+    PRIORITY_AD_HOC, PRIORITY_STATUS_CHANGE, EmailOutbox, NotificationDedup, OutboxFull, SendBudget,
+    SMTPConnectionPool, compose_digest,
+)
+from subscriptions import SubscriptionStore
+from application_numbers import MAX_NUMBER, canonical_key, canonical_number, canonical_numbers
+from bulk_check import (
+    FORMATS as BULK_FORMATS, ODS_MIMETYPE, check_numbers, chunked, iter_uploaded_numbers, open_upload,
+)
+from working_days import WorkingDayCalendar, parse_closures
+from near_match import (
+    NearMatchIndex, mask_application_number, read_index as read_near_match_index,
+    write_index as write_near_match_index,
+)
+from number_ranges import (
+    DecisionRanges, prefix_spans, read_ranges as read_decision_ranges, write_ranges as write_decision_ranges,
+)
 
 # Set up logging
 logging.basicConfig(filename='visa_debug.log', level=logging.DEBUG, 
@@ -49,75 +82,460 @@ def process_row(row):
                 return application_number, {"status": "Approved", "application_date": "2024-01-01"}
     return None, None
 
-def read_ods_file(file_path):
-    logging.debug("Reading visa_status.ods file...")
-    df = pd.read_excel(file_path, engine="odf", header=None)
-    logging.debug(f"Total rows in sheet: {len(df)}")
-    return df
-
-def process_visa_row(row):
-    if pd.notna(row[2]) and pd.notna(row[3]):
-        application_number = str(row[2]).strip()
-        decision = str(row[3]).strip().lower()
-        if decision in ["approved", "refused"]:
-            return application_number, {"status": decision.capitalize(), "application_date": "2024-01-01"}
-    return None, None
+# Which table check_status reads from: 'array' (sorted numpy arrays, a few
+# bytes per application), 'dict' (the original dict-of-dicts) or 'sqlite'
+# (an indexed SQLite file at VISA_SQLITE_PATH that outlives the process).
+VISA_STORE = os.environ.get('VISA_STORE', 'array')
+VISA_SQLITE_PATH = os.environ.get('VISA_SQLITE_PATH', 'visa_database.sqlite')
 
-def process_dataframe(df):
-    visa_database = {}
-    for index in range(len(df) - 1, -1, -1):
-        row = df.iloc[index]
-        application_number, visa_info = process_visa_row(row)
-        
-        if application_number == "Application Number":
-            break
-        
-        if application_number and visa_info:
-            visa_database[application_number] = visa_info
+# Where the decisions come from: one .ods file, a directory of weekly or
+# monthly exports, or a glob such as 'decisions/*.ods'. Where files
+# disagree about a number, the one whose name sorts last wins, so name
+# exports after the period they cover, e.g. decisions-2024-10-17.ods.
+# (Modification times would be no good: checkouts and deploys reset them.)
+VISA_STATUS_SOURCE = os.environ.get('VISA_STATUS_SOURCE', 'visa_status.ods')
+
+def visa_source_files(source=VISA_STATUS_SOURCE):
+    """The decision files behind the database, oldest (by file name) first."""
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, '*.ods'))
+    elif any(char in source for char in '*?['):
+        paths = glob.glob(source)
+    else:
+        paths = [source] if os.path.exists(source) else []
+    return sorted(paths, key=lambda path: (os.path.basename(path), path))
+
+def build_visa_database(paths):
+    if len(paths) == 1:
+        store = build_visa_store(paths[0])
+    else:
+        # Files are independent until the final merge, so parse them side by
+        # side. build_visa_store lives in visa_ingest so workers never need
+        # this module, which loads the database (and holds the import lock)
+        # while the pool runs.
+        workers = min(len(paths), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+            stores = list(pool.map(build_visa_store, paths))
+        # Newest file first, so its decision wins for numbers that repeat.
+        store = ArrayStore.combine(reversed(stores))
+    return store
+
+# The merged database every process maps read-only. Whichever process
+# first finds it missing or stale rebuilds it under an exclusive lock and
+# bumps its generation; the others just map what it published, so each
+# extra gunicorn worker shares the same pages instead of building a copy.
+VISA_SHARED_SNAPSHOT = os.environ.get('VISA_SHARED_SNAPSHOT', 'visa_database.snapshot')
+
+def shared_snapshot_identity():
+    try:
+        stat = os.stat(VISA_SHARED_SNAPSHOT)
+    except FileNotFoundError:
+        return None
+    return [stat.st_ino, stat.st_mtime_ns]
+
+def publish_visa_database(paths, seen_generation=None):
+    """Return (database, generation) for paths from the shared snapshot,
+    rebuilding and publishing a new generation first if it is stale.
+
+    With seen_generation the snapshot is rebuilt even if it looks current,
+    unless another process already published a generation newer than it.
+    """
+    signature = {"files": sources_signature(paths)}
+
+    def usable(snapshot):
+        return (snapshot is not None and snapshot.header["source"] == signature
+                and (seen_generation is None or snapshot.generation > seen_generation))
+
+    snapshot = read_snapshot(VISA_SHARED_SNAPSHOT)
+    if usable(snapshot):
+        return snapshot.to_store(), snapshot.generation
+
+    with open(f"{VISA_SHARED_SNAPSHOT}.lock", "a") as lock:
+        # Released when the file is closed, even if the build fails.
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        snapshot = read_snapshot(VISA_SHARED_SNAPSHOT)
+        if usable(snapshot):
+            return snapshot.to_store(), snapshot.generation
+
+        store = build_visa_database(paths)
+        generation = max(snapshot.generation if snapshot else 0, seen_generation or 0) + 1
+        try:
+            write_snapshot(store, VISA_SHARED_SNAPSHOT, signature, generation=generation)
+        except OSError as e:
+            logger.warning(f"Could not publish shared visa snapshot: {str(e)}")
+            return store, generation
+    return read_snapshot(VISA_SHARED_SNAPSHOT).to_store(), generation
+
+# Target false-positive rate of the Bloom filter that answers most "Not
+# Found" checks without probing the store; 0 disables the filter. Only the
+# SQLite store gets one: for the in-memory stores a lookup is already
+# cheaper than the filter.
+VISA_FILTER_FPR = float(os.environ.get('VISA_FILTER_FPR', 0.01))
+
+def prepare_visa_database(store, generation):
+    """Turn a freshly published store into the table check_status reads."""
+    if VISA_STORE == 'sqlite':
+        visa_database = SQLiteStore(VISA_SQLITE_PATH)
+        visa_database.sync(store, generation)
+    elif VISA_STORE == 'dict':
+        visa_database = dict(store.items())
+    else:
+        visa_database = store
+    if VISA_STORE == 'sqlite' and VISA_FILTER_FPR > 0:
+        visa_database = FilteredStore(visa_database, BloomFilter.from_store(store, VISA_FILTER_FPR))
     return visa_database
 
+def filter_stats(visa_database):
+    if not isinstance(visa_database, FilteredStore):
+        return None
+    membership_filter = visa_database.filter
+    return {
+        "bytes": membership_filter.nbytes,
+        "hashes": membership_filter.hashes,
+        "false_positive_rate": round(membership_filter.false_positive_rate, 6),
+    }
+
 def load_visa_database():
-    if not os.path.exists('visa_status.ods'):
-        print("visa_status.ods file not found. Using empty database.")
-        return {}
+    """Return (table, store, generation): the table check_status reads and
+    the shared snapshot store it was prepared from."""
+    paths = visa_source_files()
+    if not paths:
+        print(f"{VISA_STATUS_SOURCE} file not found. Using empty database.")
+        return {}, {}, 0
 
     try:
-        df = read_ods_file('visa_status.ods')
-        visa_database = process_dataframe(df)
-        print_database_summary(visa_database)
-        return visa_database
+        store, generation = publish_visa_database(paths)
+        visa_database = prepare_visa_database(store, generation)
+        print_database_summary(visa_database, paths)
+        return visa_database, store, generation
     except Exception as e:
         print(f"Error loading visa database: {str(e)}")
-        return {}
+        return {}, {}, 0
 
-def print_database_summary(visa_database):
-    print(f"Loaded {len(visa_database)} visa records from visa_status.ods")
-    print(f"First 10 entries: {dict(list(visa_database.items())[:10])}")
-    print(f"Last 10 entries: {dict(list(visa_database.items())[-10:])}")
+def print_database_summary(visa_database, paths):
+    print(f"Loaded {len(visa_database)} visa records from {', '.join(paths)}")
+    first_entries = {key: visa_database[key] for key in islice(visa_database, 10)}
+    last_entries = {key: visa_database[key] for key in islice(reversed(visa_database), 10)}
+    print(f"First 10 entries: {first_entries}")
+    print(f"Last 10 entries: {last_entries}")
     print(f"Is 68728912 in database? {visa_database.get('68728912', 'Not found')}")
+    stats = filter_stats(visa_database)
+    if stats:
+        print(f"Membership filter: {stats['bytes'] / 1024:.1f} KiB, {stats['hashes']} hashes, "
+              f"{stats['false_positive_rate']:.2%} expected false positives")
+
+def sources_signature(paths):
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        signature.append([path, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+# "Did you mean" suggestions for numbers that are not found: at most
+# VISA_SUGGEST_LIMIT numbers within VISA_SUGGEST_DISTANCE edits. 0 turns
+# them off and skips building their index. Distance 1 (one typo) answers
+# in well under a millisecond; 2 also searches two typos away when none is
+# one away, which takes a millisecond or two on millions of numbers.
+# Unless VISA_SUGGEST_MASK is 0, suggestions only show their last four digits.
+VISA_SUGGEST_LIMIT = int(os.environ.get('VISA_SUGGEST_LIMIT', 3))
+VISA_SUGGEST_DISTANCE = int(os.environ.get('VISA_SUGGEST_DISTANCE', 1))
+VISA_SUGGEST_MASK = os.environ.get('VISA_SUGGEST_MASK', '1') == '1'
+VISA_NEAR_MATCH_INDEX = f"{VISA_SHARED_SNAPSHOT}.near"
+
+def map_shared_index(path, read, build, write):
+    """read(path), an index derived from the shared snapshot and mapped
+    from a file next to it. Like the snapshot, the first process to find
+    the file missing or built from other data builds the index under the
+    lock and writes it; the rest map what it wrote."""
+    index = read(path)
+    if index is not None:
+        return index
+    with open(f"{VISA_SHARED_SNAPSHOT}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = read(path)
+        if index is not None:
+            return index
+        index = build()
+        try:
+            write(index, path)
+        except OSError as e:
+            logger.warning(f"Could not publish {path}: {str(e)}")
+            return index
+    mapped = read(path)
+    return mapped if mapped is not None else index
+
+def build_near_matches(store):
+    """The near-match index for store, mapped from the file next to the
+    shared snapshot."""
+    if VISA_SUGGEST_LIMIT <= 0 or not len(store):
+        return NearMatchIndex.from_store({})
+    return map_shared_index(VISA_NEAR_MATCH_INDEX,
+                            lambda path: read_near_match_index(path, store.numbers),
+                            lambda: NearMatchIndex.from_store(store), write_near_match_index)
+
+def near_match_stats(index):
+    return {"bytes": index.nbytes, "entries": len(index)}
+
+# Running counts per status over the sorted numbers, behind /decided_range.
+VISA_DECISION_RANGES = f"{VISA_SHARED_SNAPSHOT}.ranges"
+
+def build_decision_ranges(store):
+    """The decision ranges for store, mapped from the file next to the
+    shared snapshot."""
+    if not len(store):
+        return DecisionRanges.from_store(store)
+    return map_shared_index(VISA_DECISION_RANGES,
+                            lambda path: read_decision_ranges(path, store.numbers, store.codes, store.statuses),
+                            lambda: DecisionRanges.from_store(store),
+                            lambda ranges, path: write_decision_ranges(ranges, path, store.codes))
+
+# Everything requests read about one version of the database: the table
+# check_status reads (table), the shared snapshot behind it (store; reloads
+# diff against it, since a SQLite table is rewritten in place under every
+# worker), the near-match index, the running counts per status behind
+# /decided_range, and the stats /database_status reports, generation
+# included. A reload builds a new one and rebinds served_database once, so
+# a request that takes served_database once sees all of them from the
+# same version. Never mutated; stats changes make a new one too.
+ServedDatabase = namedtuple('ServedDatabase', 'table store near_matches decision_ranges stats')
+
+def serve_database(table, store, generation, **stats):
+    """A ServedDatabase for table, built from store, with its indexes."""
+    near_matches = build_near_matches(store)
+    return ServedDatabase(table, store, near_matches, build_decision_ranges(store), {
+        "generation": generation,
+        "records": len(table),
+        "loaded_at": datetime.now().isoformat(timespec="seconds"),
+        "filter": filter_stats(table),
+        "near_matches": near_match_stats(near_matches),
+        **stats,
+    })
+
+# Seconds between checks of the decision files for new versions; 0
+# disables hot reloading.
+VISA_RELOAD_INTERVAL = float(os.environ.get('VISA_RELOAD_INTERVAL', 30))
 
 # Make sure to reload the visa database after making changes
-visa_database = load_visa_database()
+served_database = serve_database(
+    *load_visa_database(),
+    source_signature=sources_signature(visa_source_files()),
+    shared_snapshot=shared_snapshot_identity(),
+    last_reload=None,
+    reload_errors=0,
+)
+reload_lock = threading.Lock()
 
-def calculate_working_days(start_date, end_date):
-    working_days = 0
-    current_date = start_date
-    while current_date <= end_date:
-        if current_date.weekday() < 5: 
-            working_days += 1
-        current_date += timedelta(days=1)
-    return working_days
-
-def send_email_notification(recipient, subject, body):
+def reload_visa_database(force=False):
+    """Swap in a newer database if the decision files changed or another
+    process published a new generation of the shared snapshot.
+
+    The new table and its indexes are built completely before
+    served_database is rebound, so a request that grabbed the old one
+    keeps a consistent view of it until it finishes. Subscribers are
+    notified only after the swap.
+    """
+    global served_database
+    with reload_lock:
+        served = served_database
+        stats = served.stats
+        paths = visa_source_files()
+        signature = sources_signature(paths)
+        shared = shared_snapshot_identity()
+        unchanged = signature == stats["source_signature"] and shared == stats["shared_snapshot"]
+        if not signature or (unchanged and not force):
+            return False
+
+        started = time.perf_counter()
+        try:
+            new_store, generation = publish_visa_database(
+                paths, seen_generation=stats["generation"] if force else None)
+            if generation == stats["generation"]:
+                # The snapshot was only touched; this is the table we already serve.
+                served_database = served._replace(stats={
+                    **stats, "source_signature": signature, "shared_snapshot": shared_snapshot_identity()})
+                return False
+            new_database = prepare_visa_database(new_store, generation)
+            diff = diff_databases(served.store, new_store)
+            served_database = serve_database(
+                new_database, new_store, generation,
+                source_signature=signature,
+                shared_snapshot=shared_snapshot_identity(),
+                last_reload={
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+                    "added": len(diff["added"]),
+                    "removed": len(diff["removed"]),
+                    "changed": len(diff["changed"]),
+                },
+                reload_errors=stats["reload_errors"],
+            )
+        except Exception as e:
+            logger.error(f"Error reloading visa database: {str(e)}", exc_info=True)
+            served_database = served._replace(stats={**stats, "reload_errors": stats["reload_errors"] + 1})
+            return False
+        logger.info(f"Reloaded visa database: {served_database.stats['last_reload']}")
+
+        try:
+            # As at startup, never fan out against an empty store. After one
+            # (a failed first load) the diff is everything, so catch up on
+            # the subscriptions instead; each is only emailed if its status
+            # differs from what it was last told.
+            if not len(new_store):
+                logger.warning("Reloaded an empty visa database; not notifying subscribers")
+            elif not len(served.store):
+                notify_subscribers(subscriptions.subscribed_numbers(), new_store)
+            else:
+                notify_subscribers(chain(diff["added"], diff["changed"], diff["removed"]), new_store)
+        except Exception as e:
+            logger.error(f"Error notifying subscribers: {str(e)}", exc_info=True)
+        return True
+
+def watch_visa_database():
+    while True:
+        time.sleep(VISA_RELOAD_INTERVAL)
+        try:
+            reload_visa_database()
+        except Exception as e:
+            logger.error(f"Error in visa database watcher: {str(e)}", exc_info=True)
+
+def start_visa_database_watcher():
+    if VISA_RELOAD_INTERVAL > 0:
+        threading.Thread(target=watch_visa_database, name="visa-db-reloader", daemon=True).start()
+
+# gunicorn.conf.py turns this off: threads don't survive fork, so there each
+# worker starts its own watcher once it has been forked from the master.
+if os.environ.get('VISA_WATCH_ON_IMPORT', '1') == '1':
+    start_visa_database_watcher()
+
+@app.cli.command("compile-db")
+def compile_db_command():
+    """Parse the decision files and (re)write their binary snapshots."""
+    for path in visa_source_files():
+        visa_database = compile_visa_database(path)
+        print(f"Compiled {len(visa_database)} visa records into {snapshot_path_for(path)}")
+
+@app.cli.command("bulk-check")
+@click.argument("source", type=click.File("rb"))
+@click.option("--format", "output", type=click.Choice(sorted(BULK_FORMATS)), default="ndjson")
+@click.option("--column", type=int, default=0, help="column holding the application numbers, from 0")
+@click.option("--output", "destination", type=click.File("w"), default="-",
+              help="where to write the results; stdout also gets the database summary")
+def bulk_check_command(source, output, column, destination):
+    """Check every application number in a CSV or ODS file (- for stdin)."""
+    ods = source.name.lower().endswith(".ods")
     try:
+        upload = open_upload(source, ods)
+    except (UnicodeDecodeError, zipfile.BadZipFile) as e:
+        raise click.ClickException(f"Cannot read {source.name}: {str(e)}")
+    _, formatter = BULK_FORMATS[output]
+    results = check_numbers(served_database.table, iter_uploaded_numbers(upload, ods, column))
+    for chunk in chunked(formatter(results)):
+        destination.write(chunk)
+
+# Irish public holidays, plus any office closures given as comma separated
+# YYYY-MM-DD days or YYYY-MM-DD..YYYY-MM-DD ranges, don't count as working days.
+VISA_OFFICE_CLOSURES = os.environ.get('VISA_OFFICE_CLOSURES', '')
+working_day_calendar = WorkingDayCalendar.ireland(parse_closures(VISA_OFFICE_CLOSURES))
+
+def calculate_working_days(start_date, end_date):
+    return working_day_calendar.count(start_date, end_date)
+
+def deliver_email(recipient, subject, body):
+    """Send one email now. Runs on the outbox's sender threads and raises on failure."""
+    with app.app_context():
         msg = Message(subject, recipients=[recipient])
         msg.body = body
-        mail.send(msg)
-        logger.info(f"Email sent to {recipient}")
-        return True
+        smtp_pool.send(msg)
+    logger.info(f"Email sent to {recipient}")
+
+# Requests only queue their emails; these threads talk to the mail server,
+# each over one of the pool's long-lived SMTP sessions.
+EMAIL_SENDERS = int(os.environ.get('EMAIL_SENDERS', 2))
+smtp_pool = SMTPConnectionPool(mail, size=EMAIL_SENDERS)
+atexit.register(smtp_pool.close)
+EMAIL_OUTBOX_PATH = os.environ.get('EMAIL_OUTBOX_PATH', 'email_outbox.sqlite')
+# One budget for the whole sender account, shared by every worker through
+# the outbox file. Gmail allows about 500 messages a day and dislikes bursts.
+# EMAIL_RATE_PER_SECOND=0 sends without a budget.
+EMAIL_RATE_PER_SECOND = float(os.environ.get('EMAIL_RATE_PER_SECOND', 1))
+send_budget = SendBudget(
+    rate=EMAIL_RATE_PER_SECOND,
+    burst=int(os.environ.get('EMAIL_BURST', 5)),
+    daily_limit=int(os.environ.get('EMAIL_DAILY_LIMIT', 500)),
+) if EMAIL_RATE_PER_SECOND > 0 else None
+
+def compose_status_digest(messages):
+    # Each section keeps its own subject, which names the application, so
+    # someone tracking several can tell the results apart.
+    subject = f"Visa Application Status Updates ({len(messages)})"
+    return subject, compose_digest(messages)[1]
+
+# Status notifications wait this many seconds for others to the same
+# address, so someone tracking several applications gets one email.
+EMAIL_DIGEST_WINDOW = float(os.environ.get('EMAIL_DIGEST_WINDOW', 30))
+# Sent and failed emails (addresses and bodies included) are deleted from
+# the outbox after this many days; 0 keeps them.
+EMAIL_RETENTION_DAYS = float(os.environ.get('EMAIL_RETENTION_DAYS', 30))
+outbox = EmailOutbox(deliver_email, EMAIL_OUTBOX_PATH, senders=EMAIL_SENDERS, budget=send_budget,
+                     digest_window=EMAIL_DIGEST_WINDOW, compose_digest=compose_status_digest,
+                     retention=EMAIL_RETENTION_DAYS * 86400)
+# Repeat checks of an unchanged status within EMAIL_DEDUP_TTL seconds don't
+# email the applicant again.
+notification_dedup = NotificationDedup(
+    outbox,
+    ttl=float(os.environ.get('EMAIL_DEDUP_TTL', 3600)),
+    max_entries=int(os.environ.get('EMAIL_DEDUP_MAX_ENTRIES', 100000)),
+)
+subscriptions = SubscriptionStore(outbox)
+
+# Where the app is reachable from outside, for links in emails.
+VISA_PUBLIC_URL = os.environ.get('VISA_PUBLIC_URL', os.environ.get('RENDER_EXTERNAL_URL', 'http://localhost:5000'))
+# Unsubscribe links carry the subscription, signed so nobody can cancel
+# someone else's.
+unsubscribe_tokens = URLSafeSerializer(app.config['SECRET_KEY'], salt='unsubscribe')
+
+def unsubscribe_link(application_number, email):
+    token = unsubscribe_tokens.dumps([application_number, email.strip().lower()])
+    return (f"To stop these updates for application {application_number}, visit "
+            f"{VISA_PUBLIC_URL.rstrip('/')}/unsubscribe/{token}")
+
+def status_change_message(application_number, status, email):
+    return (f"Visa Application {application_number} Status Update - {status}",
+            f"Your visa application (number {application_number}) is now {status}.\n"
+            f"{unsubscribe_link(application_number, email)}")
+
+def notify_subscribers(application_numbers, store):
+    """Email subscribers of application_numbers whose status in store changed."""
+    statuses = []
+    for application_number in application_numbers:
+        visa_info = store.get(application_number)
+        statuses.append((application_number, visa_info["status"] if visa_info else None))
+    return subscriptions.fan_out(statuses, status_change_message)
+
+# Catch up on decisions published while the app was down. An empty store
+# means the load failed (or there is nothing to compare yet); fanning out
+# against it would mark every subscription as not found and re-email
+# everyone once the next good load "adds" their decision back.
+if len(served_database.store):
+    try:
+        notify_subscribers(subscriptions.subscribed_numbers(), served_database.store)
     except Exception as e:
-        logger.error(f"Error sending email: {str(e)}", exc_info=True)
-        return False
+        logger.error(f"Error notifying subscribers: {str(e)}", exc_info=True)
+
+@app.before_first_request
+def start_email_senders():
+    # Drain mail left queued by a previous run, not just what this process adds.
+    outbox.start()
+
+def send_email_notification(recipient, subject, body, priority=PRIORITY_AD_HOC, digest=False):
+    """Queue an email and return (message_id, error); message_id is None if it could not be queued."""
+    try:
+        return outbox.enqueue(recipient, subject, body, priority, digest), ""
+    except OutboxFull as e:
+        logger.error(f"Error queueing email: {str(e)}")
+        return None, "Email notifications are delayed right now. Please check back later."
 
 @app.route('/')
 def index():
@@ -143,20 +561,26 @@ def get_csrf_token():
 @limiter.limit("10 per minute")
 def check_status():
     print("check_status route accessed")
+    # One reference for the whole request, so a hot reload mid-request
+    # cannot mix two versions of the database.
+    served = served_database
+    database, matches = served.table, served.near_matches
     try:
         print(f"Received form data: {request.form}")
         
-        application_number = request.form.get("application_number").split('.')[0]  # Remove decimal point if present
+        raw_application_number = request.form.get("application_number")
+        application_number = canonical_key(raw_application_number)
         application_date = request.form.get("application_date")
         email = request.form.get("email")
+        subscribe = request.form.get("subscribe") in ("on", "true", "1")
         
         print(f"Parsed data - Application Number: {application_number}, Date: {application_date}, Email: {email}")
-        print(f"Is {application_number} in visa_database? {application_number in visa_database}")
-        print(f"Visa database entry for {application_number}: {visa_database.get(application_number, 'Not found')}")
+        print(f"Is {application_number} in visa_database? {application_number in database}")
+        print(f"Visa database entry for {application_number}: {database.get(application_number, 'Not found')}")
         
-        if not application_number or not application_date or not email:
+        if not raw_application_number or not application_date or not email:
             missing_fields = []
-            if not application_number:
+            if not raw_application_number:
                 missing_fields.append("application_number")
             if not application_date:
                 missing_fields.append("application_date")
@@ -165,15 +589,25 @@ def check_status():
             error_message = f"Missing required fields: {', '.join(missing_fields)}"
             print(error_message)
             return jsonify({"error": error_message}), 400
+        if application_number is None:
+            print(f"Rejected application number {raw_application_number!r}")
+            return jsonify({"error": "Application number must be a whole number"}), 400
         
         print(f"Checking if {application_number} is in visa_database")
-        if application_number in visa_database:
-            visa_info = visa_database[application_number]
+        if application_number in database:
+            visa_info = database[application_number]
             status = visa_info["status"]
             print(f"Application {application_number} found in database. Status: {status}")
         else:
             status = "Not Found"
             print(f"Application {application_number} not found in database.")
+        suggestions = []
+        if status == "Not Found" and VISA_SUGGEST_LIMIT > 0:
+            for suggestion in matches.suggest(application_number, VISA_SUGGEST_DISTANCE, VISA_SUGGEST_LIMIT):
+                if VISA_SUGGEST_MASK:
+                    suggestion = mask_application_number(suggestion)
+                if suggestion not in suggestions:
+                    suggestions.append(suggestion)
         
         app_date = datetime.strptime(application_date, "%Y-%m-%d")
         current_date = datetime.now()
@@ -186,16 +620,34 @@ def check_status():
         else:
             message = f"Your visa application is {status}. It has been {working_days} working days since your application."
         
-        subject = f"Visa Application Status Update - {status}"
+        subject = f"Visa Application {application_number} Status Update - {status}"
         body = message
-        email_sent = send_email_notification(email, subject, body)
+        if subscribe:
+            subscriptions.subscribe(application_number, email, None if status == "Not Found" else status)
+            body = f"{body}\n\nWe will email you when this status changes.\n{unsubscribe_link(application_number, email)}"
+        
+        dedup_key = NotificationDedup.key(email, application_number, status)
+        should_send, previous_message_id = notification_dedup.claim(dedup_key)
+        if should_send:
+            message_id, email_error = send_email_notification(email, subject, body, PRIORITY_STATUS_CHANGE, digest=True)
+            if message_id:
+                notification_dedup.attach(dedup_key, message_id)
+            else:
+                notification_dedup.forget(dedup_key)
+            email_status = "queued" if message_id else "failed"
+        else:
+            print(f"Skipping email to {email}: {status} for {application_number} was already sent recently")
+            message_id, email_error, email_status = previous_message_id, "", "duplicate"
         
         response_data = {
             "status": status,
             "working_days": working_days,
             "message": message,
-            "email_sent": email_sent,
-            "email_error": "" if email_sent else "Failed to send email notification. Please check your email address."
+            "email_status": email_status,
+            "message_id": message_id,
+            "subscribed": subscribe,
+            "email_error": email_error,
+            "suggestions": suggestions
         }
         print(f"Sending response: {response_data}")
         return jsonify(response_data)
@@ -203,6 +655,183 @@ def check_status():
         print(f"Error in check_status route: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# How long browsers and proxies may reuse a /status answer before asking
+# again; they revalidate with its ETag, which only changes with the database.
+VISA_STATUS_MAX_AGE = int(os.environ.get('VISA_STATUS_MAX_AGE', 60))
+
+@app.route("/status/<application_number>")
+@limiter.limit("60 per minute", deduct_when=lambda response: response.status_code != 304)
+def status_lookup(application_number):
+    """Read-only, cacheable variant of /check_status: the status of one
+    application, without working days or email.
+
+    The ETag is the database generation plus the status, which is all the
+    body depends on, so it is strong and the same from every worker.
+    Conditional requests are answered with 304 Not Modified, which the
+    rate limit does not count.
+    """
+    served = served_database
+    database, stats = served.table, served.stats
+    key = canonical_key(application_number)
+    if key is None:
+        return jsonify({"error": "Application number must be a whole number"}), 400
+    try:
+        visa_info = database.get(key)
+        status = visa_info["status"] if visa_info is not None else "Not Found"
+        response = jsonify({"application_number": key, "status": status, "generation": stats["generation"]})
+        response.set_etag(f"{stats['generation']}-{status.lower().replace(' ', '-')}")
+        if stats["shared_snapshot"]:
+            response.last_modified = datetime.fromtimestamp(stats["shared_snapshot"][1] / 1e9, timezone.utc)
+        response.cache_control.public = True
+        response.cache_control.max_age = VISA_STATUS_MAX_AGE
+        return response.make_conditional(request)
+    except Exception as e:
+        logger.error(f"Error in status_lookup route: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+# Largest batch /check_status_batch accepts in one request.
+VISA_BATCH_LIMIT = int(os.environ.get('VISA_BATCH_LIMIT', 50000))
+
+@app.route("/check_status_batch", methods=["POST"])
+@csrf.exempt
+@limiter.limit("10 per minute")
+def check_status_batch():
+    """Statuses, and working days if application dates are given, for many
+    application numbers in one request. Sends no email.
+
+    Takes {"application_numbers": [...], "application_dates": [...]} where
+    application_dates is optional and either one YYYY-MM-DD date for every
+    number or a list matching application_numbers. Answers with parallel
+    lists in the same order: canonical application numbers (null for ones
+    that are not whole numbers, whose status is "Invalid"), statuses and
+    working days.
+    """
+    served = served_database
+    database, generation = served.table, served.stats["generation"]
+    data = request.get_json(silent=True) or {}
+    application_numbers = data.get("application_numbers")
+    application_dates = data.get("application_dates")
+    if not isinstance(application_numbers, list):
+        return jsonify({"error": "application_numbers must be a list"}), 400
+    if any(isinstance(number, (list, dict)) for number in application_numbers):
+        return jsonify({"error": "application_numbers must be a flat list of numbers or strings"}), 400
+    if len(application_numbers) > VISA_BATCH_LIMIT:
+        return jsonify({"error": f"At most {VISA_BATCH_LIMIT} application numbers per request"}), 400
+    if isinstance(application_dates, list) and len(application_dates) != len(application_numbers):
+        return jsonify({"error": "application_dates must match application_numbers"}), 400
+    dates = application_dates if isinstance(application_dates, list) else [application_dates]
+    if application_dates is not None and not all(isinstance(day, str) for day in dates):
+        return jsonify({"error": "application_dates must be YYYY-MM-DD strings"}), 400
+    # Numpy sizes every string in a batch to the longest one.
+    if max(map(len, map(str, application_numbers)), default=0) > 64:
+        return jsonify({"error": "Application numbers are at most 64 characters"}), 400
+
+    try:
+        numbers, valid = canonical_numbers(application_numbers)
+        if len(numbers) != len(application_numbers):
+            raise ValueError(f"{len(numbers)} results for {len(application_numbers)} application numbers")
+        keys = np.where(valid, numbers.astype(str), None)
+        statuses = np.full(len(keys), "Invalid", dtype=object)
+        statuses[valid] = lookup_statuses(database, numbers[valid], "Not Found")
+        response_data = {
+            "application_numbers": keys.tolist(),
+            "statuses": statuses.tolist(),
+            "generation": generation,
+        }
+        if application_dates is not None:
+            try:
+                starts = np.asarray(application_dates, dtype="datetime64[D]")
+            except ValueError as e:
+                return jsonify({"error": f"Invalid application_dates: {str(e)}"}), 400
+            if np.isnat(starts).any():
+                return jsonify({"error": "Invalid application_dates: missing date"}), 400
+            today = np.datetime64(datetime.now().date(), 'D')
+            response_data["working_days"] = working_day_calendar.count_many(
+                np.broadcast_to(starts, keys.shape), today).tolist()
+        return jsonify(response_data)
+    except Exception as e:
+        logger.error(f"Error in check_status_batch route: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/bulk_check", methods=["POST"])
+@csrf.exempt
+@limiter.limit("5 per minute")
+def bulk_check():
+    """Stream back the status of every application number in an uploaded
+    file, as NDJSON (default) or CSV, while the file is still being read.
+
+    The file is either the raw request body (text/csv, or ODS_MIMETYPE for
+    a spreadsheet) or a multipart "file" field. ?column= picks the column
+    holding the numbers, counting from 0; header rows are skipped.
+    """
+    database = served_database.table
+    output = request.args.get("format", "ndjson")
+    if output not in BULK_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(sorted(BULK_FORMATS))}"}), 400
+    column = request.args.get("column", "0")
+    if not column.isdigit():
+        return jsonify({"error": "column must be a column index from 0"}), 400
+
+    upload = request.files.get("file")
+    if upload is not None:
+        stream, ods = upload.stream, upload.mimetype == ODS_MIMETYPE or (upload.filename or "").lower().endswith(".ods")
+    else:
+        stream, ods = request.stream, request.mimetype == ODS_MIMETYPE
+    try:
+        upload = open_upload(stream, ods)
+    except UnicodeDecodeError:
+        return jsonify({"error": "CSV files must be UTF-8"}), 400
+    except zipfile.BadZipFile:
+        return jsonify({"error": "Not an ODS spreadsheet"}), 400
+    mimetype, formatter = BULK_FORMATS[output]
+    results = check_numbers(database, iter_uploaded_numbers(upload, ods, int(column)))
+    return Response(stream_with_context(chunked(formatter(results))), mimetype=mimetype)
+
+@app.route('/decided_range')
+def decided_range():
+    """How many applications between two numbers (?first=&last=, either
+    end optional) or starting with some digits (?prefix=) have a decision,
+    split by status, with the approval ratio and the lowest and highest
+    decided numbers among them."""
+    served = served_database
+    ranges, generation = served.decision_ranges, served.stats["generation"]
+    prefix = request.args.get("prefix")
+    if prefix is not None:
+        prefix = prefix.strip()
+        if not prefix.isdigit() or not prefix.isascii():
+            return jsonify({"error": "prefix must be digits"}), 400
+        query, spans = {"prefix": prefix}, prefix_spans(prefix)
+    else:
+        first = canonical_number(request.args.get("first", 0))
+        last = canonical_number(request.args.get("last", MAX_NUMBER))
+        if first is None or last is None:
+            return jsonify({"error": "first and last must be whole numbers"}), 400
+        if first > last:
+            return jsonify({"error": "first must not be greater than last"}), 400
+        query, spans = {"first": first, "last": last}, [(first, last)]
+    return jsonify({**query, **ranges.summary(spans), "generation": generation})
+
+@app.route('/unsubscribe/<token>', methods=['GET', 'POST'])
+@csrf.exempt
+def unsubscribe(token):
+    """Cancel the subscription an emailed link stands for. GET only asks
+    for confirmation, so mail scanners that follow links don't unsubscribe
+    anyone; the signed token is what authorizes the POST."""
+    try:
+        application_number, email = unsubscribe_tokens.loads(token)
+    except BadSignature:
+        return "This unsubscribe link is not valid.", 400
+    if request.method == 'GET':
+        return (f"<p>Stop status emails about application {application_number}?</p>"
+                f'<form method="post"><button type="submit">Unsubscribe</button></form>')
+    subscriptions.unsubscribe(application_number, email)
+    logger.info(f"Unsubscribed from application {application_number}")
+    return f"<p>You will no longer get status emails about application {application_number}.</p>"
+
+@app.route('/database_status')
+def database_status():
+    return jsonify(served_database.stats)
+
 @app.errorhandler(500)
 def internal_error(error):
     logger.error(f"Internal Server Error: {str(error)}", exc_info=True)
@@ -217,14 +846,26 @@ def send_email_route():
         subject = data["subject"]
         body = data["body"]
 
-        if send_email_notification(recipient, subject, body):
-            return jsonify({"success": True, "message": "Email sent successfully!"})
+        message_id, email_error = send_email_notification(recipient, subject, body)
+        if message_id:
+            return jsonify({"success": True, "message": "Email queued for delivery!", "message_id": message_id})
         else:
-            return jsonify({"success": False, "message": "Error sending email"})
+            return jsonify({"success": False, "message": email_error})
     except Exception as e:
         logger.error(f"Error in send_email route: {str(e)}", exc_info=True)
         return jsonify({"success": False, "message": f"Error sending email: {str(e)}"}), 500
 
+@app.route('/email_status/<message_id>')
+def email_status(message_id):
+    record = outbox.status(message_id)
+    if record is None:
+        return jsonify({"error": "Unknown message id"}), 404
+    return jsonify(record)
+
+@app.route('/email_metrics')
+def email_metrics():
+    return jsonify(outbox.metrics())
+
 @app.route('/static/<path:filename>')
 def serve_static(filename):
     logger.info(f"Serving static file: {filename}")
@@ -0,0 +1,91 @@
+"""Canonical form of application numbers.
+
+The same application can reach us as 48056052, "48056052.0" (a number
+cell read as a float), " 048056052" or 48056052.0. Ingest and every
+lookup path pass what they get through here, so all of those become the
+integer 48056052 and its string key "48056052". Anything that is not a
+whole number of at most MAX_DIGITS digits is rejected as None (or as
+invalid in the vectorized form), before it reaches a store.
+"""
+import math
+from numbers import Integral, Real
+
+import numpy as np
+
+# Keeps every canonical number within int64.
+MAX_DIGITS = 18
+MAX_NUMBER = 10 ** MAX_DIGITS - 1
+
+
+def canonical_number(value):
+    """The application number value stands for, as an int, or None.
+
+    Accepts ints, integral floats and strings of ASCII digits with
+    optional surrounding whitespace, leading zeros and an all-zero
+    fraction ("123.0").
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, Integral):
+        return int(value) if 0 <= value <= MAX_NUMBER else None
+    if isinstance(value, Real):
+        # -0.0 is refused like the string "-0".
+        whole = float(value).is_integer() and math.copysign(1, value) > 0
+        return int(value) if whole and value <= MAX_NUMBER else None
+    if not isinstance(value, str):
+        return None
+    digits, _, fraction = value.strip().partition(".")
+    if not digits.isdigit() or not digits.isascii() or fraction.strip("0"):
+        return None
+    digits = digits.lstrip("0") or "0"
+    return int(digits) if len(digits) <= MAX_DIGITS else None
+
+
+def canonical_key(value):
+    """canonical_number as the string key stores are indexed by, or None."""
+    number = canonical_number(value)
+    return None if number is None else str(number)
+
+
+def _is_whole_float(value):
+    return (isinstance(value, Real) and not isinstance(value, Integral)
+            and math.isfinite(value) and float(value).is_integer())
+
+
+def canonical_numbers(values):
+    """canonical_number over a whole list or array at once.
+
+    Returns (numbers, valid): an int64 array, and a bool array that is
+    False where values held something canonical_number rejects (numbers
+    is 0 there). The digits are parsed column by column over their UCS-4
+    code points, so there is no per-value Python work.
+    """
+    keys = np.asarray(values, dtype=str).reshape(-1)
+    # As text numpy writes large floats in exponent form ("1e+16"); put
+    # whole ones back as their digits, as canonical_number reads them.
+    exponents = np.flatnonzero(np.char.find(keys, "e") >= 0)
+    if len(exponents):
+        originals = np.asarray(values, dtype=object).reshape(-1)
+        keys = keys.astype(f"U{max(keys.dtype.itemsize // 4, MAX_DIGITS + 2)}")
+        for index in exponents.tolist():
+            if _is_whole_float(originals[index]):
+                keys[index] = str(int(originals[index]))
+    if not keys.size:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    parts = np.char.partition(np.char.strip(keys), ".")
+    digits, fractions = parts[:, 0], parts[:, 2]
+    significant = np.char.lstrip(digits, "0")
+    significant[(significant == "") & (digits != "")] = "0"
+
+    lengths = np.char.str_len(significant)
+    width = min(significant.dtype.itemsize // 4, MAX_DIGITS)
+    chars = np.ascontiguousarray(significant.astype(f"U{max(width, 1)}")).view(np.uint32).reshape(len(keys), -1)
+    is_digit = (chars >= 48) & (chars <= 57)
+    valid = ((is_digit.sum(axis=1) == lengths) & (lengths > 0) & (lengths <= MAX_DIGITS)
+             & (np.char.str_len(np.char.strip(fractions, "0")) == 0))
+
+    numbers = np.zeros(len(keys), dtype=np.int64)
+    for column in range(chars.shape[1]):
+        numbers = np.where(is_digit[:, column], numbers * 10 + (chars[:, column].astype(np.int64) - 48), numbers)
+    numbers[~valid] = 0
+    return numbers, valid
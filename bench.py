@@ -0,0 +1,561 @@
+"""Ad-hoc benchmarks for the visa database hot paths.
+
+Run from the repository root, e.g.::
+
+    python bench.py ingest --rows 1000000
+
+The benchmarks work on synthetic data written to a scratch directory.
+Besides the app's requirements they need pandas and odfpy.
+"""
+import argparse
+import collections
+import datetime
+import logging
+import multiprocessing
+import os
+import random
+import sqlite3
+import socketserver
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import visa_ingest
+import visa_store
+import working_days
+from application_numbers import canonical_key, canonical_numbers
+
+
+def timed(label, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed * 1000:>12.1f} ms")
+    return result, elapsed
+
+
+# The pandas/odfpy ingest the app used before visa_ingest's streaming
+# reader, kept as the reference the benchmarks and tests compare against.
+# Only this module needs pandas and odfpy; the app does not.
+
+def read_ods_file(file_path):
+    return pd.read_excel(file_path, engine="odf", header=None)
+
+
+def process_visa_row(row):
+    if pd.notna(row[2]) and pd.notna(row[3]):
+        application_number = canonical_key(row[2])
+        decision = str(row[3]).strip().lower()
+        if application_number and decision in ["approved", "refused"]:
+            return application_number, {"status": decision.capitalize(), "application_date": "2024-01-01"}
+    return None, None
+
+
+def process_dataframe(df):
+    # Column-oriented equivalent of running process_visa_row over every row
+    # from the bottom up: the rows are normalised and filtered as whole
+    # columns, and where an application number repeats the topmost row wins,
+    # just like the old reverse iloc loop did.
+    if df.shape[1] < 4:
+        return {}
+
+    numbers = df.iloc[:, 2]
+    decisions = df.iloc[:, 3]
+    present = numbers.notna().to_numpy() & decisions.notna().to_numpy()
+    # The cells themselves go to canonical_numbers: as text, a float cell
+    # such as 1e16 would read "1e+16".
+    numbers = numbers[present].to_numpy(dtype=object)
+    decisions = decisions[present]
+
+    header = np.flatnonzero(np.char.strip(numbers.astype(str)) == "Application Number")
+    if len(header):
+        numbers = numbers[header[0] + 1:]
+        decisions = decisions.iloc[header[0] + 1:]
+
+    # Only a handful of distinct decision strings exist, so normalise those
+    # and broadcast the result back through the factorized codes.
+    codes, labels = pd.factorize(decisions.astype(str))
+    normalized = pd.Index(labels).str.strip().str.lower()
+    statuses = np.where(normalized.isin(["approved", "refused"]), normalized.str.capitalize(), None)
+    statuses = statuses[codes]
+
+    numbers, valid = canonical_numbers(numbers)
+    rows = pd.DataFrame({"application_number": numbers.astype(str), "status": statuses})
+    rows = rows[rows["status"].notna() & valid]
+    rows = rows.iloc[::-1].drop_duplicates("application_number", keep="last")
+
+    return {
+        application_number: {"status": status, "application_date": "2024-01-01"}
+        for application_number, status in zip(rows["application_number"].tolist(), rows["status"].tolist())
+    }
+
+
+def synthetic_sheet(rows, seed=0):
+    """Build a DataFrame shaped like pd.read_excel's view of the decisions sheet."""
+    rng = np.random.default_rng(seed)
+    numbers = rng.integers(40_000_000, 80_000_000, size=rows).astype(object)
+    decisions = np.where(rng.random(rows) < 0.92, "Approved", "Refused").astype(object)
+    preamble = pd.DataFrame({
+        0: [np.nan] * 3,
+        1: ["Application Decisions:", np.nan, "Mission: New Delhi"],
+        2: [np.nan, np.nan, "Application Number"],
+        3: [np.nan, np.nan, "Decision"],
+    })
+    body = pd.DataFrame({0: np.nan, 1: np.nan, 2: numbers, 3: decisions})
+    return pd.concat([preamble, body], ignore_index=True)
+
+
+def legacy_process_dataframe(df):
+    """The original per-row iloc loop, kept here as the reference implementation."""
+    visa_database = {}
+    for index in range(len(df) - 1, -1, -1):
+        row = df.iloc[index]
+        application_number, visa_info = process_visa_row(row)
+        if application_number == "Application Number":
+            break
+        if application_number and visa_info:
+            visa_database[application_number] = visa_info
+    return visa_database
+
+
+def bench_ingest(args):
+    df = synthetic_sheet(args.rows)
+    print(f"Synthetic sheet: {len(df)} rows")
+    fast, fast_time = timed("process_dataframe (vectorized)", process_dataframe, df)
+    if args.skip_legacy:
+        return
+    legacy_rows = min(args.rows, args.legacy_rows)
+    sample = df.iloc[:legacy_rows + 3]
+    legacy, legacy_time = timed(f"legacy iloc loop ({legacy_rows} rows)", legacy_process_dataframe, sample)
+    assert legacy == process_dataframe(sample), "vectorized ingest disagrees with legacy loop"
+    projected = legacy_time * len(df) / len(sample)
+    print(f"{'legacy projected to full sheet':<40} {projected * 1000:>12.1f} ms")
+    print(f"Speedup: {projected / fast_time:.0f}x ({len(fast)} unique applications)")
+
+
+def synthetic_ods(path, rows, seed=0):
+    """Write an ODS file laid out like the published decisions report."""
+    rng = np.random.default_rng(seed)
+    numbers = rng.integers(40_000_000, 80_000_000, size=rows)
+    refused = rng.random(rows) >= 0.92
+    cell = '<table:table-cell office:value-type="string"><text:p>{}</text:p></table:table-cell>'
+    head = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<office:document-content'
+        ' xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"'
+        ' xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0"'
+        ' xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0">'
+        '<office:body><office:spreadsheet><table:table table:name="ApplicationDecisionReport">'
+        '<table:table-row><table:table-cell table:number-columns-repeated="2"/>'
+        + cell.format("Application Number") + cell.format("Decision") +
+        '<table:table-cell table:number-columns-repeated="16380"/></table:table-row>'
+    )
+    tail = (
+        '<table:table-row table:number-rows-repeated="999669">'
+        '<table:table-cell table:number-columns-repeated="16384"/></table:table-row>'
+        '</table:table></office:spreadsheet></office:body></office:document-content>'
+    )
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(zipfile.ZipInfo("mimetype"), "application/vnd.oasis.opendocument.spreadsheet")
+        archive.writestr("META-INF/manifest.xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0">'
+            '<manifest:file-entry manifest:full-path="/" manifest:media-type="application/vnd.oasis.opendocument.spreadsheet"/>'
+            '<manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>'
+            '</manifest:manifest>'
+        ))
+        with archive.open("content.xml", "w") as content:
+            content.write(head.encode())
+            for number, is_refused in zip(numbers.tolist(), refused.tolist()):
+                content.write((
+                    '<table:table-row><table:table-cell table:number-columns-repeated="2"/>'
+                    f'<table:table-cell office:value-type="float" office:value="{number}"><text:p>{number}</text:p></table:table-cell>'
+                    + cell.format("Refused" if is_refused else "Approved") +
+                    '<table:table-cell table:number-columns-repeated="16380"/></table:table-row>'
+                ).encode())
+            content.write(tail.encode())
+
+
+def traced(label, func, *args):
+    """Time func, then run it again under tracemalloc to report its peak allocation."""
+    result, elapsed = timed(label, func, *args)
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    print(f"{'':<40} {peak / 2**20:>12.1f} MiB peak")
+    return result, elapsed
+
+
+def bench_ods(args):
+    for rows in args.rows:
+        path = os.path.join(args.scratch, f"synthetic-{rows}.ods")
+        synthetic_ods(path, rows)
+        print(f"Synthetic ODS: {rows} rows, {os.path.getsize(path) / 2**20:.1f} MiB compressed")
+        traced("iter_ods_decisions (reader only)", lambda: sum(1 for _ in visa_ingest.iter_ods_decisions(path)))
+        streamed, _ = traced("streaming reader + dict build", lambda: visa_ingest.process_decision_rows(visa_ingest.iter_ods_decisions(path)))
+        if rows <= args.legacy_rows:
+            legacy, _ = traced("pandas/odfpy read_excel", lambda: process_dataframe(read_ods_file(path)))
+            assert legacy == streamed, "streaming reader disagrees with read_excel"
+
+
+def synthetic_database(rows, seed=0):
+    return process_dataframe(synthetic_sheet(rows, seed))
+
+
+def resident_bytes():
+    """Current RSS from /proc; sqlite's own allocations are invisible to tracemalloc."""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def bench_store(args):
+    visa_database = synthetic_database(args.rows)
+    probes = list(visa_database)[:args.lookups]
+    probes += [str(number) for number in range(10_000_000, 10_000_000 + args.lookups)]
+    print(f"{len(visa_database)} applications, {len(probes)} lookups (half misses)")
+
+    sqlite_path = os.path.join(args.scratch, "bench.sqlite")
+    timed("sqlite: bulk load", visa_store.SQLiteStore(sqlite_path).sync,
+          visa_store.ArrayStore.from_mapping(visa_database), 1)
+
+    for label, build in (
+        ("dict", lambda: synthetic_database(args.rows)),
+        ("array", lambda: visa_store.ArrayStore.from_mapping(visa_database)),
+        ("sqlite", lambda: visa_store.SQLiteStore(sqlite_path)),
+    ):
+        rss = resident_bytes()
+        tracemalloc.start()
+        store = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        _, elapsed = timed(f"{label}: {len(probes)} lookups", lambda store=store: [store.get(key) for key in probes])
+        rss = resident_bytes() - rss
+        print(f"{'':<40} {size / 2**20:>12.1f} MiB allocated, {rss / 2**20:.1f} MiB RSS growth, "
+              f"{elapsed / len(probes) * 1e6:.2f} us/lookup")
+        del store
+    print(f"sqlite file: {os.path.getsize(sqlite_path) / 2**20:.1f} MiB")
+
+
+def bench_filter(args):
+    store = visa_store.ArrayStore.from_mapping(synthetic_database(args.rows))
+    membership_filter, _ = timed("BloomFilter.from_store", visa_store.BloomFilter.from_store, store, args.fpr)
+    filtered = visa_store.FilteredStore(store, membership_filter)
+    misses = [str(number) for number in range(10_000_000, 10_000_000 + args.lookups)]
+    hits = list(store)[:args.lookups]
+    print(f"{len(store)} applications; filter {membership_filter.nbytes / 1024:.1f} KiB, "
+          f"{membership_filter.hashes} hashes, {membership_filter.false_positive_rate:.2%} expected FPR")
+
+    for label, database in (("array store", store), ("filtered array store", filtered)):
+        _, elapsed = timed(f"{label}: {len(misses)} misses", lambda: [key in database for key in misses])
+        print(f"{'':<40} {elapsed / len(misses) * 1e6:>12.2f} us/lookup")
+        _, elapsed = timed(f"{label}: {len(hits)} hits", lambda: [key in database for key in hits])
+        print(f"{'':<40} {elapsed / len(hits) * 1e6:>12.2f} us/lookup")
+
+    false_positives = sum(membership_filter.might_contain(key) for key in misses)
+    assert all(membership_filter.might_contain(key) for key in hits), "filter rejected a stored number"
+    print(f"Measured false-positive rate: {false_positives / len(misses):.2%}")
+
+
+def legacy_working_days(start_date, end_date):
+    working_days = 0
+    current_date = start_date
+    while current_date <= end_date:
+        if current_date.weekday() < 5:
+            working_days += 1
+        current_date += datetime.timedelta(days=1)
+    return working_days
+
+
+def bench_workdays(args):
+    rng = np.random.default_rng(0)
+    end = np.datetime64("2026-01-01")
+    starts = end - rng.integers(0, args.max_age, args.rows).astype("timedelta64[D]")
+    calendar, _ = timed("WorkingDayCalendar.ireland", working_days.WorkingDayCalendar.ireland)
+    end_date = end.astype(object)
+    sample = [start.astype(object) for start in starts[:args.legacy_rows]]
+
+    _, elapsed = timed(f"day loop: {len(sample)} ranges", lambda: [legacy_working_days(start, end_date) for start in sample])
+    print(f"{'':<40} {elapsed / len(sample) * 1e6:>12.2f} us/range")
+    _, elapsed = timed(f"count: {len(sample)} ranges", lambda: [calendar.count(start, end_date) for start in sample])
+    print(f"{'':<40} {elapsed / len(sample) * 1e6:>12.2f} us/range")
+    _, elapsed = timed(f"count_many: {len(starts)} ranges", calendar.count_many, starts, end)
+    print(f"{'':<40} {elapsed / len(starts) * 1e6:>12.3f} us/range")
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept mail; sleeps on connect to stand in for
+    the TLS handshake and login a real server needs. Recipients at
+    bounce.example.com are refused for good, and a fraction of messages
+    get a temporary 451 failure."""
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        server = self.server
+        time.sleep(server.handshake_delay)
+        self.reply("220 stand-in ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.split(b" ", 1)[0].strip().upper()
+            if command == b"EHLO":
+                self.reply("250-stand-in")
+                self.reply("250 8BITMIME")
+            elif command == b"RCPT" and b"@bounce.example.com" in line:
+                self.reply("550 no such mailbox")
+            elif command == b"DATA":
+                self.reply("354 end with .")
+                subject = None
+                while (data := self.rfile.readline()) not in (b".\r\n", b""):
+                    if data.startswith(b"Subject: "):
+                        subject = data[9:].strip().decode()
+                if server.random.random() < server.failure_rate:
+                    self.reply("451 try again later")
+                    continue
+                with server.lock:
+                    server.received[subject] += 1
+                self.reply("250 queued")
+            elif command == b"QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+def stand_in_smtp_server(handshake_delay, failure_rate=0.0):
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), StandInSMTPHandler)
+    server.daemon_threads = True
+    server.handshake_delay = handshake_delay
+    server.failure_rate = failure_rate
+    server.random = random.Random(0)
+    server.lock = threading.Lock()
+    server.received = collections.Counter()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def mail_app(server):
+    from flask import Flask
+    from flask_mail import Mail
+
+    flask_app = Flask(__name__)
+    flask_app.config.update(MAIL_SERVER="127.0.0.1", MAIL_PORT=server.server_address[1],
+                            MAIL_DEFAULT_SENDER="bench@example.com")
+    return flask_app, Mail(flask_app)
+
+
+def bench_smtp(args):
+    from flask_mail import Message
+
+    from email_outbox import SMTPConnectionPool
+
+    server = stand_in_smtp_server(args.handshake_ms / 1000)
+    flask_app, mail = mail_app(server)
+    pool = SMTPConnectionPool(mail, size=args.senders)
+
+    def message(index):
+        return Message(f"Status update {index}", recipients=["applicant@example.com"], body="Approved")
+
+    def drain(send):
+        """Send args.messages messages from args.senders threads, like the outbox does."""
+        indexes = iter(range(args.messages))
+        lock = threading.Lock()
+
+        def sender():
+            with flask_app.app_context():
+                while True:
+                    with lock:
+                        index = next(indexes, None)
+                    if index is None:
+                        return
+                    send(message(index))
+
+        threads = [threading.Thread(target=sender) for _ in range(args.senders)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    print(f"{args.messages} messages, {args.senders} senders, {args.handshake_ms} ms simulated handshake")
+    for label, send in (("mail.send (connection per message)", mail.send), ("SMTPConnectionPool.send", pool.send)):
+        _, elapsed = timed(label, drain, send)
+        print(f"{'':<40} {args.messages / elapsed:>12.1f} messages/s")
+    with flask_app.app_context():
+        pool.close()
+    assert sum(server.received.values()) == 2 * args.messages, "stand-in server lost messages"
+    server.shutdown()
+
+
+def bench_outbox(args):
+    """Push messages through durable outboxes in several processes and check
+    each is delivered exactly once, or dead-lettered if it bounces."""
+    from flask_mail import Message
+
+    from email_outbox import PRIORITY_AD_HOC, PRIORITY_STATUS_CHANGE, EmailOutbox, SendBudget, SMTPConnectionPool
+
+    server = stand_in_smtp_server(args.handshake_ms / 1000, args.failure_rate)
+    # Retries and bounces are expected here; keep their log lines quiet.
+    logging.getLogger("email_outbox").setLevel(logging.CRITICAL)
+    path = os.path.join(args.scratch, "outbox.sqlite")
+    options = dict(senders=args.senders, max_queued=args.messages, backoff_base=0.01, backoff_cap=0.1,
+                   poll_interval=0.05, max_attempts=args.max_attempts,
+                   budget=SendBudget(args.rate, args.burst) if args.rate else None)
+    outbox = EmailOutbox(None, path, **options)
+    bounces = 0
+    for index in range(args.messages):
+        bounced = index % 100 == 0
+        bounces += bounced
+        domain = "bounce.example.com" if bounced else "example.com"
+        # Alternate priorities so the budget has something to choose between.
+        priority = PRIORITY_STATUS_CHANGE if index % 2 else PRIORITY_AD_HOC
+        outbox.enqueue(f"applicant{index}@{domain}", f"status-{index}", "Approved", priority)
+    print(f"Queued {args.messages} messages ({bounces} to a bouncing domain), "
+          f"{args.processes} processes x {args.senders} senders, {args.failure_rate:.0%} transient failures"
+          + (f", budget {args.rate}/s burst {args.burst}" if args.rate else ""))
+
+    def drain():
+        flask_app, mail = mail_app(server)
+        pool = SMTPConnectionPool(mail, size=args.senders)
+
+        def send(recipient, subject, body):
+            with flask_app.app_context():
+                pool.send(Message(subject, recipients=[recipient], body=body))
+
+        EmailOutbox(send, path, **options).start()
+        while outbox.pending():
+            time.sleep(0.05)
+
+    context = multiprocessing.get_context("fork")
+    start = time.perf_counter()
+    processes = [context.Process(target=drain) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    counts = outbox.counts()
+    print(f"{'drained':<40} {elapsed * 1000:>12.1f} ms, {args.messages / elapsed:.1f} messages/s")
+    with sqlite3.connect(path) as connection:
+        for priority, average_wait in connection.execute(
+                "SELECT priority, AVG(sent_ts - queued_ts) FROM outbox WHERE status = 'sent' GROUP BY priority"):
+            print(f"{f'priority {priority} average wait':<40} {average_wait * 1000:>12.1f} ms")
+    print(f"Outbox: {counts}; stand-in received {sum(server.received.values())} messages")
+    duplicates = [subject for subject, times in server.received.items() if times > 1]
+    assert not duplicates, f"delivered more than once: {duplicates[:5]}"
+    assert counts.get("failed", 0) >= bounces, "bounced messages were not dead-lettered"
+    assert len(server.received) == counts["sent"], "outbox and server disagree on what was sent"
+    assert counts["sent"] + counts.get("failed", 0) == args.messages, "messages were lost"
+
+
+def bench_fanout(args):
+    """diff_databases plus SubscriptionStore.fan_out after a reload that
+    changes some statuses, with many subscriptions on file."""
+    from email_outbox import EmailOutbox
+    from subscriptions import SubscriptionStore
+
+    old = visa_store.ArrayStore.from_mapping(synthetic_database(args.rows))
+    rng = np.random.default_rng(1)
+    flipped = rng.choice(len(old.numbers), size=args.changed, replace=False)
+    codes = old.codes.copy()
+    codes[flipped] ^= 1
+    new = visa_store.ArrayStore(old.numbers, codes)
+
+    outbox = EmailOutbox(None, os.path.join(args.scratch, "fanout.sqlite"))
+    subscriptions = SubscriptionStore(outbox)
+    subscribed = rng.choice(old.numbers, size=args.subscriptions).astype(str).tolist()
+    connection = outbox.connection()
+    connection.execute("BEGIN")
+    connection.executemany(
+        "INSERT OR IGNORE INTO subscriptions VALUES (?, ?, ?, 0)",
+        ((number, f"applicant{index}@example.com", old[number]["status"]) for index, number in enumerate(subscribed)))
+    connection.execute("COMMIT")
+    print(f"{len(old)} applications, {args.changed} changed, {len(subscriptions)} subscriptions")
+
+    diff, _ = timed("diff_databases", visa_store.diff_databases, old, new)
+    statuses, _ = timed("look up new statuses", lambda: [(key, new[key]["status"]) for key in diff["changed"]])
+    queued, _ = timed("fan_out", subscriptions.fan_out, statuses,
+                      lambda number, status, email: (f"Status update - {status}", f"{number} is now {status}"))
+    again, _ = timed("fan_out again (nothing left)", subscriptions.fan_out, statuses,
+                     lambda number, status, email: (f"Status update - {status}", f"{number} is now {status}"))
+    expected = sum(1 for number in subscribed if new[number] != old[number])
+    print(f"Queued {queued} notifications, then {again}")
+    assert queued == expected and again == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    ingest = sub.add_parser("ingest", help="process_dataframe vs the legacy iloc loop")
+    ingest.add_argument("--rows", type=int, default=1_000_000)
+    ingest.add_argument("--legacy-rows", type=int, default=100_000,
+                        help="rows to run through the slow legacy loop before extrapolating")
+    ingest.add_argument("--skip-legacy", action="store_true")
+    ingest.set_defaults(func=bench_ingest)
+
+    ods = sub.add_parser("ods", help="streaming ODS reader vs pandas read_excel")
+    ods.add_argument("--rows", type=int, nargs="+", default=[50_000, 500_000])
+    ods.add_argument("--legacy-rows", type=int, default=50_000,
+                     help="largest sheet to also push through read_excel")
+    ods.set_defaults(func=bench_ods)
+
+    store = sub.add_parser("store", help="dict-of-dicts vs ArrayStore vs SQLite memory and lookup cost")
+    store.add_argument("--rows", type=int, default=1_000_000)
+    store.add_argument("--lookups", type=int, default=100_000)
+    store.set_defaults(func=bench_store)
+
+    bloom = sub.add_parser("filter", help="lookups with and without the Bloom filter in front")
+    bloom.add_argument("--rows", type=int, default=1_000_000)
+    bloom.add_argument("--lookups", type=int, default=100_000)
+    bloom.add_argument("--fpr", type=float, default=0.01)
+    bloom.set_defaults(func=bench_filter)
+
+    workdays = sub.add_parser("workdays", help="working-day counts: day loop vs closed form vs vectorized")
+    workdays.add_argument("--rows", type=int, default=1_000_000)
+    workdays.add_argument("--max-age", type=int, default=3650, help="oldest application, in days")
+    workdays.add_argument("--legacy-rows", type=int, default=10_000)
+    workdays.set_defaults(func=bench_workdays)
+
+    smtp = sub.add_parser("smtp", help="Flask-Mail sends with and without the SMTP connection pool")
+    smtp.add_argument("--messages", type=int, default=500)
+    smtp.add_argument("--senders", type=int, default=2)
+    smtp.add_argument("--handshake-ms", type=float, default=20,
+                      help="delay before the greeting, standing in for TLS and login")
+    smtp.set_defaults(func=bench_smtp)
+
+    durable = sub.add_parser("outbox", help="drain the durable email outbox from several processes")
+    durable.add_argument("--messages", type=int, default=5000)
+    durable.add_argument("--processes", type=int, default=2)
+    durable.add_argument("--senders", type=int, default=2)
+    durable.add_argument("--failure-rate", type=float, default=0.05,
+                         help="fraction of messages the stand-in server answers with 451")
+    durable.add_argument("--max-attempts", type=int, default=8)
+    durable.add_argument("--handshake-ms", type=float, default=20)
+    durable.add_argument("--rate", type=float, default=0, help="send budget per second; 0 for none")
+    durable.add_argument("--burst", type=int, default=5)
+    durable.set_defaults(func=bench_outbox)
+
+    fanout = sub.add_parser("fanout", help="reload diff and subscription fan-out")
+    fanout.add_argument("--rows", type=int, default=1_000_000)
+    fanout.add_argument("--changed", type=int, default=20_000)
+    fanout.add_argument("--subscriptions", type=int, default=500_000)
+    fanout.set_defaults(func=bench_fanout)
+
+    args = parser.parse_args()
+    args.scratch = tempfile.mkdtemp(prefix="visa-bench-")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
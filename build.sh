@@ -4,4 +4,7 @@ set -o errexit
 echo "Installing dependencies..."
 pip install -r requirements.txt
 
+echo "Compiling visa database snapshot..."
+FLASK_APP=app flask compile-db
+
 echo "Build process completed."
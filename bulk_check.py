@@ -0,0 +1,137 @@
+"""Checking whole files of application numbers.
+
+An uploaded CSV or ODS file is read a row at a time and its numbers are
+looked up in batches, so results can be written out while the file is
+still being read and memory stays flat however long the file is. Used by
+the /bulk_check route and the ``flask bulk-check`` command.
+"""
+import csv
+import io
+import json
+import shutil
+import tempfile
+import zipfile
+from itertools import chain, islice
+
+import numpy as np
+
+from application_numbers import canonical_numbers
+from visa_ingest import OdsDecisionReader
+from visa_store import lookup_statuses
+
+ODS_MIMETYPE = "application/vnd.oasis.opendocument.spreadsheet"
+HEADER_VALUES = ("application number", "application_number")
+
+
+def iter_csv_numbers(lines, column=0):
+    """Application numbers from one column of CSV lines (bytes or str).
+    A line that is not UTF-8 is decoded with replacement characters, so
+    its number comes out invalid instead of ending the whole file."""
+    text = (line.decode("utf-8-sig", errors="replace") if isinstance(line, bytes) else line for line in lines)
+    for row in csv.reader(text):
+        if len(row) > column:
+            yield row[column]
+
+
+def iter_ods_numbers(file, column=0):
+    """Application numbers from one column of the first sheet of an ODS
+    file (a path or a seekable binary file)."""
+    # The reader keeps rows where both of its columns have a value;
+    # pointing both at the same column keeps every non-empty cell.
+    reader = OdsDecisionReader(file, number_column=column, decision_column=column)
+    return (value for value, _ in reader)
+
+
+def spool(stream, max_memory=1 << 20):
+    """Copy a stream into a seekable temporary file, as reading a zip needs."""
+    spooled = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    shutil.copyfileobj(stream, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+def open_upload(stream, ods=False):
+    """Check that an uploaded file is what it claims to be, before any
+    result is sent, and return it ready for iter_uploaded_numbers.
+
+    CSV (or one number per line) must start with a UTF-8 line; an ODS
+    file, a zip whose index sits at the end, is spooled to disk (unless
+    the stream is seekable) and must hold a content.xml. Raises
+    UnicodeDecodeError or zipfile.BadZipFile otherwise.
+    """
+    if not ods:
+        first = stream.readline()
+        if isinstance(first, bytes):
+            first.decode("utf-8-sig")
+        return chain([first], stream)
+    file = stream if stream.seekable() else spool(stream)
+    try:
+        with zipfile.ZipFile(file) as archive:
+            if "content.xml" not in archive.namelist():
+                raise zipfile.BadZipFile("not an ODS file: no content.xml")
+    except BaseException:
+        file.close()
+        raise
+    file.seek(0)
+    return file
+
+
+def iter_uploaded_numbers(upload, ods=False, column=0):
+    """Application numbers from a file returned by open_upload. CSV is
+    parsed as it arrives; ODS is parsed incrementally from the spooled
+    file, which is closed at the end."""
+    if not ods:
+        yield from iter_csv_numbers(upload, column)
+        return
+    with upload:
+        yield from iter_ods_numbers(upload, column)
+
+
+def check_numbers(visa_database, application_numbers, batch_size=1000):
+    """Yield (application_number, status) for each number: its canonical
+    form and status, "Not Found" when visa_database has no record, or the
+    number as given and "Invalid" when it is not an application number.
+    Numbers are looked up a batch at a time; header rows and blank cells
+    are skipped."""
+    application_numbers = (number.strip() for number in application_numbers)
+    application_numbers = (number for number in application_numbers
+                           if number and number.lower() not in HEADER_VALUES)
+    while True:
+        batch = list(islice(application_numbers, batch_size))
+        if not batch:
+            return
+        numbers, valid = canonical_numbers(batch)
+        keys = np.where(valid, numbers.astype(str), np.asarray(batch, dtype=str))
+        statuses = np.full(len(batch), "Invalid", dtype=object)
+        statuses[valid] = lookup_statuses(visa_database, numbers[valid], "Not Found")
+        yield from zip(keys.tolist(), statuses.tolist())
+
+
+def format_ndjson(results):
+    for application_number, status in results:
+        yield json.dumps({"application_number": application_number, "status": status}) + "\n"
+
+
+def format_csv(results):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for row in chain([("application_number", "status")], results):
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def chunked(lines, lines_per_chunk=1000):
+    """Join lines into fewer, larger pieces for writing out."""
+    while True:
+        chunk = "".join(islice(lines, lines_per_chunk))
+        if not chunk:
+            return
+        yield chunk
+
+
+FORMATS = {
+    "ndjson": ("application/x-ndjson", format_ndjson),
+    "csv": ("text/csv", format_csv),
+}
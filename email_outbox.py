@@ -0,0 +1,538 @@
+"""Background delivery of notification emails.
+
+Requests hand messages to an EmailOutbox and return straight away; a few
+sender threads per process drain its on-disk queue and talk to the mail
+server through an SMTPConnectionPool. Each message gets an id whose
+delivery status can be looked up afterwards from any process.
+"""
+import hashlib
+import logging
+import os
+import random
+import smtplib
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+# Higher goes first when the send budget is the bottleneck.
+PRIORITY_STATUS_CHANGE = 10
+PRIORITY_AD_HOC = 0
+
+
+class OutboxFull(Exception):
+    pass
+
+
+def compose_digest(messages):
+    """One (subject, body) standing for several messages to the same recipient."""
+    subject = f"{len(messages)} notifications"
+    body = "\n\n".join(f"{message_subject}\n\n{message_body}" for message_subject, message_body in messages)
+    return subject, body
+
+
+class SendBudget:
+    """Token bucket pacing sends from every process sharing an outbox file.
+
+    Tokens refill at rate per second up to burst; daily_limit (0 for none)
+    caps sends per UTC day. The state is one row in the outbox database, so
+    it is only read and updated inside the outbox's claim transaction.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS send_budget ("
+        " id INTEGER PRIMARY KEY CHECK (id = 1), tokens REAL NOT NULL, updated_at REAL NOT NULL,"
+        " day TEXT NOT NULL, sent_today INTEGER NOT NULL)",
+    )
+
+    def __init__(self, rate, burst=1, daily_limit=0):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.daily_limit = daily_limit
+
+    def _state(self, connection, now):
+        row = connection.execute("SELECT tokens, updated_at, day, sent_today FROM send_budget").fetchone()
+        today = time.strftime("%Y-%m-%d", time.gmtime(now))
+        if row is None:
+            return self.burst, today, 0
+        tokens, updated_at, day, sent_today = row
+        tokens = min(self.burst, tokens + max(0, now - updated_at) * self.rate)
+        return tokens, today, sent_today if day == today else 0
+
+    def take(self, connection, now):
+        """Spend one send if the budget allows and return 0, else return the
+        seconds until it might."""
+        tokens, today, sent_today = self._state(connection, now)
+        if self.daily_limit and sent_today >= self.daily_limit:
+            wait = 86400 - now % 86400
+        elif tokens < 1:
+            wait = (1 - tokens) / self.rate
+        else:
+            tokens, sent_today, wait = tokens - 1, sent_today + 1, 0
+        connection.execute("INSERT OR REPLACE INTO send_budget VALUES (1, ?, ?, ?, ?)",
+                           (tokens, now, today, sent_today))
+        return wait
+
+    def metrics(self, connection, now):
+        tokens, _, sent_today = self._state(connection, now)
+        return {"tokens": round(tokens, 2), "rate_per_second": self.rate, "burst": self.burst,
+                "sent_today": sent_today, "daily_limit": self.daily_limit}
+
+
+class EmailOutbox:
+    """Durable queue of outgoing emails, drained by background sender threads.
+
+    Messages live in a SQLite file (WAL mode) shared by every process that
+    opens it, so queued mail survives restarts and any worker can report a
+    message's status. send(recipient, subject, body) does the delivery and
+    raises on failure. Failures are retried with exponential backoff and
+    jitter; permanent SMTP rejections, and messages still failing after
+    max_attempts, are dead-lettered with status "failed".
+
+    A sender claims a message by marking it "sending" in the same
+    transaction that selects it, so no two senders deliver the same row. A
+    claim older than claim_timeout (its sender died mid-send) goes back to
+    the queue. With a SendBudget, a claim also has to win a send from it;
+    due messages are claimed highest priority first.
+
+    Messages queued with digest=True are held for digest_window seconds,
+    and whichever of them is claimed first takes every other pending digest
+    message to the same recipient along (up to max_digest), so they go out
+    as one email built by compose_digest.
+
+    Sent and failed messages are deleted retention seconds after they were
+    finished (0 keeps them), checked every PURGE_EVERY deliveries, so the
+    file does not keep every address and body it ever handled.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        " message_id TEXT PRIMARY KEY, recipient TEXT NOT NULL, subject TEXT NOT NULL,"
+        " body TEXT NOT NULL, status TEXT NOT NULL, priority INTEGER NOT NULL DEFAULT 0,"
+        " digest INTEGER NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0,"
+        " next_attempt_at REAL NOT NULL, queued_at TEXT NOT NULL, queued_ts REAL NOT NULL,"
+        " claimed_at REAL, sent_at TEXT, sent_ts REAL, error TEXT)",
+        "CREATE INDEX IF NOT EXISTS outbox_next ON outbox (status, priority DESC, next_attempt_at)",
+        "CREATE INDEX IF NOT EXISTS outbox_recipient ON outbox (recipient, status)",
+        "CREATE INDEX IF NOT EXISTS outbox_finished ON outbox (status, sent_ts)",
+    )
+    STATUS_FIELDS = ("message_id", "status", "attempts", "queued_at", "sent_at", "error")
+    # Old sent and failed messages are purged every this many deliveries.
+    PURGE_EVERY = 100
+
+    def __init__(self, send, path, senders=2, max_queued=10000, max_attempts=8,
+                 backoff_base=5, backoff_cap=3600, claim_timeout=600, poll_interval=1, budget=None,
+                 digest_window=0, max_digest=50, compose_digest=compose_digest, retention=30 * 86400):
+        self.send = send
+        self.retention = retention
+        self._deliveries = 0
+        self.budget = budget
+        self.digest_window = digest_window
+        self.max_digest = max_digest
+        self.compose_digest = compose_digest
+        self.path = path
+        self.senders = senders
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started_in = None
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        for statement in self.SCHEMA + SendBudget.SCHEMA:
+            connection.execute(statement)
+
+    def connection(self):
+        """This thread's connection to the outbox database.
+
+        One per thread, and per process: a connection inherited across fork
+        must not be used.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def start(self):
+        """Start this process's sender threads, once.
+
+        Not done at import, so a gunicorn master that preloads the app forks
+        workers without dead sender threads; the pid check restarts them in
+        a process forked after they were started."""
+        if self._started_in == os.getpid():
+            return
+        with self._lock:
+            if self._started_in == os.getpid():
+                return
+            try:
+                self.purge()
+            except sqlite3.Error as e:
+                logger.error(f"Error purging email outbox: {str(e)}", exc_info=True)
+            for index in range(self.senders):
+                threading.Thread(target=self._run, name=f"email-sender-{index}", daemon=True).start()
+            self._started_in = os.getpid()
+
+    def purge(self, now=None):
+        """Delete messages that were sent, or given up on, more than
+        retention seconds ago; returns how many."""
+        if not self.retention:
+            return 0
+        cutoff = (now or time.time()) - self.retention
+        connection = self.connection()
+        # Failed messages record when they were given up on in next_attempt_at.
+        purged = connection.execute(
+            "DELETE FROM outbox WHERE status = 'sent' AND sent_ts < ?", (cutoff,)).rowcount
+        purged += connection.execute(
+            "DELETE FROM outbox WHERE status = 'failed' AND next_attempt_at < ?", (cutoff,)).rowcount
+        if purged:
+            logger.info(f"Purged {purged} finished emails from the outbox")
+        return purged
+
+    def enqueue(self, recipient, subject, body, priority=PRIORITY_AD_HOC, digest=False):
+        """Queue a message and return its id; raises OutboxFull if the queue is full."""
+        if self.pending() >= self.max_queued:
+            raise OutboxFull("Too many emails waiting to be sent")
+        return self.enqueue_many([(recipient, subject, body)], priority, digest)[0]
+
+    def enqueue_many(self, messages, priority=PRIORITY_AD_HOC, digest=False):
+        """Queue (recipient, subject, body) tuples in one transaction, or in
+        the caller's if one is open on this thread's connection, and return
+        their ids. Not limited by max_queued."""
+        now = time.time()
+        queued_at = datetime.now().isoformat(timespec="seconds")
+        due = now + self.digest_window if digest else now
+        rows = [(uuid.uuid4().hex, recipient, subject, body, priority, due, queued_at, now, int(digest))
+                for recipient, subject, body in messages]
+        connection = self.connection()
+        owns_transaction = not connection.in_transaction
+        if owns_transaction:
+            connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT INTO outbox (message_id, recipient, subject, body, status, priority, next_attempt_at,"
+                " queued_at, queued_ts, digest) VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?, ?)", rows)
+            if owns_transaction:
+                connection.execute("COMMIT")
+        except BaseException:
+            if owns_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        self._wakeup.set()
+        return [row[0] for row in rows]
+
+    def status(self, message_id):
+        row = self.connection().execute(
+            f"SELECT {', '.join(self.STATUS_FIELDS)} FROM outbox WHERE message_id = ?", (message_id,)).fetchone()
+        if row is None:
+            return None
+        return {field: value for field, value in zip(self.STATUS_FIELDS, row) if value is not None}
+
+    def pending(self):
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM outbox WHERE status IN ('queued', 'sending')").fetchone()[0]
+
+    def counts(self):
+        return dict(self.connection().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status"))
+
+    def metrics(self, window=3600):
+        """Queue depth per priority, how long the oldest waiting message has
+        waited, queue-to-sent times over the last window seconds, and the
+        send budget."""
+        connection = self.connection()
+        now = time.time()
+        depth = dict(connection.execute(
+            "SELECT priority, COUNT(*) FROM outbox WHERE status = 'queued' GROUP BY priority"))
+        oldest = connection.execute("SELECT MIN(queued_ts) FROM outbox WHERE status = 'queued'").fetchone()[0]
+        sent, average_wait, max_wait = connection.execute(
+            "SELECT COUNT(*), AVG(sent_ts - queued_ts), MAX(sent_ts - queued_ts) FROM outbox"
+            " WHERE status = 'sent' AND sent_ts >= ?", (now - window,)).fetchone()
+        return {
+            "queued": {str(priority): count for priority, count in sorted(depth.items(), reverse=True)},
+            "sending": connection.execute("SELECT COUNT(*) FROM outbox WHERE status = 'sending'").fetchone()[0],
+            "oldest_queued_seconds": round(now - oldest, 1) if oldest else 0,
+            "sent_in_window": sent,
+            "window_seconds": window,
+            "average_wait_seconds": round(average_wait or 0, 3),
+            "max_wait_seconds": round(max_wait or 0, 3),
+            "budget": self.budget.metrics(connection, now) if self.budget else None,
+        }
+
+    def _claim(self):
+        """Mark the next due message, and any digest companions, as sending
+        and return (messages, None), or (None, seconds to wait) when nothing
+        can be sent yet. Each message is (message_id, recipient, subject,
+        body, attempts)."""
+        connection = self.connection()
+        now = time.time()
+        wait = None
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "UPDATE outbox SET status = 'queued' WHERE status = 'sending' AND claimed_at < ?",
+                (now - self.claim_timeout,))
+            row = connection.execute(
+                "SELECT message_id, recipient, subject, body, attempts, digest FROM outbox"
+                " WHERE status = 'queued' AND next_attempt_at <= ?"
+                " ORDER BY priority DESC, next_attempt_at LIMIT 1",
+                (now,)).fetchone()
+            if row is not None and self.budget is not None:
+                wait = self.budget.take(connection, now) or None
+                if wait:
+                    row = None
+            messages = None
+            if row is not None:
+                messages = [row[:5]]
+                if row[5]:
+                    messages += connection.execute(
+                        "SELECT message_id, recipient, subject, body, attempts FROM outbox"
+                        " WHERE recipient = ? AND status = 'queued' AND digest = 1 AND message_id != ?"
+                        " ORDER BY queued_ts LIMIT ?",
+                        (row[1], row[0], self.max_digest - 1)).fetchall()
+                connection.executemany(
+                    "UPDATE outbox SET status = 'sending', claimed_at = ? WHERE message_id = ?",
+                    [(now, message[0]) for message in messages])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return messages, wait
+
+    def _is_permanent(self, error):
+        # 5xx replies (unknown mailbox, policy rejection) will not improve on
+        # a retry; network trouble and 4xx replies might.
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(code >= 500 for code, _ in error.recipients.values())
+        return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_cap, self.backoff_base * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def _deliver(self, messages):
+        recipient = messages[0][1]
+        if len(messages) == 1:
+            subject, body = messages[0][2:4]
+        else:
+            subject, body = self.compose_digest([message[2:4] for message in messages])
+        try:
+            self.send(recipient, subject, body)
+        except Exception as e:
+            updates = []
+            for message_id, _, _, _, attempts in messages:
+                attempts += 1
+                if self._is_permanent(e) or attempts >= self.max_attempts:
+                    logger.error(f"Giving up on email {message_id} after {attempts} attempts: {str(e)}", exc_info=True)
+                    updates.append(("failed", attempts, time.time(), str(e), message_id))
+                else:
+                    logger.warning(f"Email {message_id} failed (attempt {attempts}), will retry: {str(e)}")
+                    updates.append(("queued", attempts, time.time() + self._backoff(attempts), str(e), message_id))
+            self.connection().executemany(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, error = ? WHERE message_id = ?",
+                updates)
+        else:
+            sent_at, sent_ts = datetime.now().isoformat(timespec="seconds"), time.time()
+            self.connection().executemany(
+                "UPDATE outbox SET status = 'sent', attempts = ?, sent_at = ?, sent_ts = ?, error = NULL"
+                " WHERE message_id = ?",
+                [(attempts + 1, sent_at, sent_ts, message_id) for message_id, _, _, _, attempts in messages])
+
+    def _run(self):
+        while True:
+            # Cleared before looking, so mail queued meanwhile still wakes us.
+            self._wakeup.clear()
+            wait = None
+            try:
+                messages, wait = self._claim()
+                if messages:
+                    self._deliver(messages)
+                    self._deliveries += 1
+                    if self._deliveries % self.PURGE_EVERY == 0:
+                        self.purge()
+                    continue
+            except Exception as e:
+                # Whatever went wrong, this sender keeps running; a dead
+                # thread would silently stop the mail.
+                logger.error(f"Error in email outbox: {str(e)}", exc_info=True)
+            # Mail queued by this process wakes us at once; other processes'
+            # mail and retries coming due are picked up by polling. An
+            # exhausted send budget says how long to back off instead.
+            self._wakeup.wait(wait or self.poll_interval)
+
+
+class NotificationDedup:
+    """Remembers recently queued notifications so a repeat is not emailed.
+
+    Entries are keyed on (email, application number, status), kept in the
+    outbox database so every worker sees them, and expire after ttl
+    seconds. Beyond max_entries the least recently used are evicted.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS notification_dedup ("
+        " key TEXT PRIMARY KEY, message_id TEXT, recorded_at REAL NOT NULL, last_used REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS notification_dedup_recorded ON notification_dedup (recorded_at)",
+        "CREATE INDEX IF NOT EXISTS notification_dedup_used ON notification_dedup (last_used)",
+    )
+    # Expiry and the size cap are enforced every this many claims.
+    EVICT_EVERY = 100
+
+    def __init__(self, outbox, ttl=3600, max_entries=100000):
+        self.outbox = outbox
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._claims = 0
+        connection = outbox.connection()
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+
+    @staticmethod
+    def key(email, application_number, status):
+        return hashlib.sha256(f"{email.strip().lower()}\x00{application_number}\x00{status}".encode()).hexdigest()
+
+    def claim(self, key):
+        """Return (True, None) if key is new or expired, now recorded, so
+        the caller should send; else (False, message_id of the earlier one)."""
+        connection = self.outbox.connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT message_id FROM notification_dedup WHERE key = ? AND recorded_at > ?",
+                (key, now - self.ttl)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE notification_dedup SET last_used = ? WHERE key = ?", (now, key))
+            else:
+                connection.execute("INSERT OR REPLACE INTO notification_dedup VALUES (?, NULL, ?, ?)", (key, now, now))
+                self._claims += 1
+                if self._claims % self.EVICT_EVERY == 0:
+                    self._evict(connection, now)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return (True, None) if row is None else (False, row[0])
+
+    def attach(self, key, message_id):
+        self.outbox.connection().execute(
+            "UPDATE notification_dedup SET message_id = ? WHERE key = ?", (message_id, key))
+
+    def forget(self, key):
+        """Drop a claim whose email could not be queued after all."""
+        self.outbox.connection().execute("DELETE FROM notification_dedup WHERE key = ?", (key,))
+
+    def _evict(self, connection, now):
+        connection.execute("DELETE FROM notification_dedup WHERE recorded_at <= ?", (now - self.ttl,))
+        excess = connection.execute("SELECT COUNT(*) FROM notification_dedup").fetchone()[0] - self.max_entries
+        if excess > 0:
+            connection.execute(
+                "DELETE FROM notification_dedup WHERE key IN"
+                " (SELECT key FROM notification_dedup ORDER BY last_used LIMIT ?)", (excess,))
+
+
+class SMTPConnectionPool:
+    """Keeps authenticated Flask-Mail connections open between sends.
+
+    mail.send() connects, runs STARTTLS and logs in for every message. The
+    pool hands out already open connections instead. A connection that sat
+    idle for noop_after seconds is checked with NOOP first, and one idle for
+    more than max_idle is replaced, since servers drop quiet sessions. A
+    pooled connection that turns out to be dead mid-send is replaced and the
+    message retried once. Must be used inside an app context, like mail.send.
+    """
+
+    # Errors meaning the session is gone rather than the message rejected.
+    DISCONNECTED = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+    def __init__(self, mail, size=2, noop_after=10, max_idle=300):
+        self.mail = mail
+        self.size = size
+        self.noop_after = noop_after
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        connection = self.mail.connect()
+        connection.__enter__()
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def _is_alive(self, connection):
+        if connection.host is None:
+            # MAIL_SUPPRESS_SEND: nothing to go stale.
+            return True
+        idle = time.monotonic() - connection.last_used
+        if idle > self.max_idle:
+            return False
+        if idle <= self.noop_after:
+            return True
+        try:
+            return connection.host.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _acquire(self):
+        """Return (connection, reused)."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection = self._idle.pop()
+            if self._is_alive(connection):
+                return connection, True
+            self._close(connection)
+        return self._open(), False
+
+    def _release(self, connection):
+        connection.last_used = time.monotonic()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        self._close(connection)
+
+    def send(self, message):
+        connection, reused = self._acquire()
+        try:
+            connection.send(message)
+        except self.DISCONNECTED:
+            self._close(connection)
+            if not reused:
+                raise
+            logger.info("Pooled SMTP connection went stale; reconnecting")
+            connection = self._open()
+            try:
+                connection.send(message)
+            except self.DISCONNECTED:
+                self._close(connection)
+                raise
+            except Exception:
+                self._release(connection)
+                raise
+        except Exception:
+            # Rejected message, healthy session: keep it.
+            self._release(connection)
+            raise
+        self._release(connection)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._close(connection)
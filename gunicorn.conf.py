@@ -0,0 +1,17 @@
+"""Gunicorn settings, picked up automatically by ``gunicorn app:app``.
+
+The master imports the app once (preload_app) so the visa database is
+built, or its shared snapshot mapped, before any worker forks. Workers
+inherit that mapping and start their own reload watchers.
+"""
+import os
+
+preload_app = True
+
+os.environ.setdefault("VISA_WATCH_ON_IMPORT", "0")
+
+
+def post_worker_init(worker):
+    import app
+
+    app.start_visa_database_watcher()
@@ -0,0 +1,362 @@
+"""Suggestions ("did you mean ...?") for application numbers that are not found.
+
+NearMatchIndex is a deletion neighbourhood over the digit strings of the
+stored numbers: every number is indexed under each string it turns into
+when one digit is deleted. Two numbers one edit apart always share such
+a string (or one is the other with a digit deleted), so a query only has
+to look up itself and its one-digit deletions: a few binary searches,
+whatever the size of the database. Numbers two edits away are found by
+doing the same for every string one edit from the query; the few of
+those that may really be three edits away (a digit moved) are checked
+with a real edit distance.
+
+A deleted string is packed into an int64 with its length (its value times
+32, plus its length), so leading zeros left by the deletion survive. Each
+entry carries one byte, the deleted position times 10 plus the deleted
+digit, from which the original number is rebuilt. That is 9 bytes per
+distinct deletion, roughly 8 per 8-digit number.
+
+Building the index for millions of numbers takes seconds, so it is
+written to a file next to the shared snapshot (see write_index) and every
+worker maps the same pages read-only, as it does the snapshot.
+
+Index file layout (little endian):
+
+    8 bytes   magic  b"VISANEAR"
+    4 bytes   format version
+    4 bytes   length of the JSON header that follows
+    N bytes   JSON header (fingerprint of the numbers, key count),
+              padded with spaces to an 8 byte boundary
+    8*count   keys, sorted, int64
+    1*count   entries, uint8
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+from application_numbers import MAX_DIGITS
+
+logger = logging.getLogger(__name__)
+
+POWERS_OF_TEN = 10 ** np.arange(MAX_DIGITS + 1, dtype=np.int64)
+
+INDEX_MAGIC = b"VISANEAR"
+INDEX_VERSION = 1
+INDEX_PREAMBLE = struct.Struct("<8sII")
+
+
+def _pack(value, length):
+    return value * 32 + length
+
+
+def _digit_counts(numbers):
+    return np.maximum(np.searchsorted(POWERS_OF_TEN, numbers, side="right"), 1)
+
+
+def edit_distance(a, b, limit):
+    """Optimal string alignment distance between a and b (substitutions,
+    insertions, deletions and adjacent transpositions), or limit + 1 if it
+    is larger than limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    # Near matches mostly differ in a short stretch; a common prefix and
+    # suffix don't change the distance.
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and end < len(b) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a, b = a[start:len(a) - end], b[start:len(b) - end]
+    if not a or not b:
+        return min(len(a) + len(b), limit + 1)
+
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+    return min(current[-1], limit + 1)
+
+
+def _differing_digits(a, b):
+    """Digits that differ between equal-length digit strings a and b
+    (arrays of values)."""
+    differing = np.zeros(np.broadcast(a, b).shape, dtype=np.int64)
+    for place in POWERS_OF_TEN[:-1]:
+        differing += a // place % 10 != b // place % 10
+    return differing
+
+
+def mask_application_number(application_number, visible=4):
+    """Hide all but the last few digits of a suggestion from someone who
+    may not own it."""
+    hidden = max(len(application_number) - visible, 0)
+    return "*" * hidden + application_number[hidden:]
+
+
+def _deletions(values, lengths):
+    """Every one-digit deletion of each (value, length) digit string, as
+    (values, lengths, positions, deleted digits, index of the source)."""
+    parts = []
+    for length in np.unique(lengths).tolist():
+        if length == 0:
+            continue
+        source = np.flatnonzero(lengths == length)
+        value = values[source][:, np.newaxis]
+        place = POWERS_OF_TEN[length - 1 - np.arange(length)]
+        deleted = (value // (place * 10) * place + value % place).ravel()
+        parts.append((deleted, np.full(len(deleted), length - 1), np.tile(np.arange(length), len(source)),
+                      (value // place % 10).ravel(), source.repeat(length)))
+    if not parts:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, empty, empty
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+
+def _insert(values, lengths, positions, digits):
+    """values (digit strings of lengths) with digits inserted at positions."""
+    place = POWERS_OF_TEN[lengths - positions]
+    return (values // place * 10 + digits) * place + values % place
+
+
+class NearMatchIndex:
+    """Application numbers close to a given one, from a sorted int64 array
+    of stored numbers (an ArrayStore's numbers)."""
+
+    def __init__(self, numbers, keys, entries):
+        self.numbers = np.asarray(numbers, dtype=np.int64)
+        self.keys = np.asarray(keys, dtype=np.int64)
+        self.entries = np.asarray(entries, dtype=np.uint8)
+        # Single queries bisect these in C, without numpy's per-call overhead.
+        self._numbers = memoryview(self.numbers)
+        self._keys = memoryview(self.keys)
+
+    @classmethod
+    def build(cls, numbers):
+        numbers = np.asarray(numbers, dtype=np.int64)
+        values, lengths, positions, digits, source = _deletions(numbers, _digit_counts(numbers))
+        # Deleting any digit of a run gives the same string; keep only the
+        # last of each run.
+        following = np.where(lengths > positions, values // POWERS_OF_TEN[np.maximum(lengths - positions - 1, 0)] % 10, -1)
+        keep = digits != following
+        keys = _pack(values[keep], lengths[keep])
+        order = np.argsort(keys, kind="stable")
+        return cls(numbers, keys[order], (positions[keep] * 10 + digits[keep]).astype(np.uint8)[order])
+
+    @classmethod
+    def from_store(cls, store):
+        return cls.build(getattr(store, "numbers", np.empty(0, dtype=np.int64)))
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.entries.nbytes
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _is_stored(self, digits):
+        if not digits or len(digits) > MAX_DIGITS or (digits[0] == "0" and digits != "0"):
+            return False
+        number = int(digits)
+        index = bisect_left(self._numbers, number)
+        return index < len(self._numbers) and self._numbers[index] == number
+
+    def _sharing(self, digits):
+        """Stored numbers that become digits when one of theirs is deleted,
+        as (number, deleted position) pairs."""
+        if len(digits) >= MAX_DIGITS:
+            return
+        key = _pack(int(digits or 0), len(digits))
+        start, end = bisect_left(self._keys, key), bisect_right(self._keys, key)
+        for entry in self.entries[start:end].tolist():
+            position, digit = divmod(entry, 10)
+            yield digits[:position] + str(digit) + digits[position:], position
+
+    def _nearby(self, query):
+        """Stored numbers one edit from query, and some two edits away (a
+        digit moved from one place to another), with their distances."""
+        found = {}
+        for candidate, _ in self._sharing(query):
+            found[candidate] = 1
+        swaps = {query[:i] + query[i + 1] + query[i] + query[i + 2:] for i in range(len(query) - 1)}
+        for position in range(len(query)):
+            deleted = query[:position] + query[position + 1:]
+            if self._is_stored(deleted):
+                found[deleted] = 1
+            for candidate, _ in self._sharing(deleted):
+                if candidate in found:
+                    continue
+                # Same length as query: a substitution or a swap of
+                # neighbours is one edit, any other move two.
+                substitution = sum(a != b for a, b in zip(candidate, query)) == 1
+                found[candidate] = 1 if substitution or candidate in swaps else 2
+        found.pop(query, None)
+        return found
+
+    def _stored(self, values, lengths):
+        """Indexes of the (value, length) digit strings that are stored
+        numbers."""
+        canonical = np.flatnonzero((lengths > 0) & (values >= POWERS_OF_TEN[np.maximum(lengths - 1, 0)] * (lengths > 1)))
+        # Sorted needles walk the arrays in order, which matters once they
+        # are larger than the cache.
+        canonical = canonical[np.argsort(values[canonical], kind="stable")]
+        if not len(self.numbers):
+            return canonical[:0]
+        needles = values[canonical]
+        at = self.numbers[np.minimum(np.searchsorted(self.numbers, needles), len(self.numbers) - 1)]
+        return canonical[at == needles]
+
+    def _inserted(self, values, lengths):
+        """Stored numbers that are one of the (value, length) digit strings
+        with a digit inserted, and the index of that string."""
+        usable = np.flatnonzero(lengths < MAX_DIGITS)
+        keys = _pack(values[usable], lengths[usable])
+        order = np.argsort(keys, kind="stable")
+        keys, usable = keys[order], usable[order]
+        starts = np.searchsorted(self.keys, keys, side="left")
+        counts = np.searchsorted(self.keys, keys, side="right") - starts
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        positions, digits = np.divmod(self.entries[np.repeat(starts, counts) + offsets].astype(np.int64), 10)
+        keys = np.repeat(keys, counts)
+        return _insert(keys // 32, keys % 32, positions, digits), np.repeat(usable, counts)
+
+    def _within_one(self, values, lengths, exact):
+        """Stored numbers within one edit of any of the (value, length)
+        digit strings, plus some at two (a digit moved), as a sorted array
+        and a bool array that is True where the number is certainly within
+        one edit, not counting swaps, of a string that is exact."""
+        deleted, deleted_lengths, _, _, source = _deletions(values, lengths)
+        stored, stored_deleted = self._stored(values, lengths), self._stored(deleted, deleted_lengths)
+        inserted, inserted_into = self._inserted(values, lengths)
+        # Sharing a deletion with a string: a substitution when only one
+        # digit differs, otherwise a swap of neighbours or a move.
+        shared, sharing = self._inserted(deleted, deleted_lengths)
+        sharing = source[sharing]
+
+        found = np.concatenate([values[stored], deleted[stored_deleted], inserted, shared])
+        certain = np.concatenate([exact[stored], exact[source[stored_deleted]], exact[inserted_into],
+                                  exact[sharing] & (_differing_digits(shared, values[sharing]) <= 1)])
+        numbers = np.unique(found)
+        return numbers, np.isin(numbers, found[certain])
+
+    def _two_away(self, query, limit):
+        """Up to limit stored numbers two edits from query, numerically
+        closest first."""
+        number, length = np.array([int(query)]), np.array([len(query)])
+        deleted, deleted_lengths, _, _, _ = _deletions(number, length)
+        # Every string one edit from query: deletions, insertions,
+        # substitutions (an insertion where a digit was deleted) and swaps.
+        places = np.arange(len(query) + 1).repeat(10)
+        digits = np.tile(np.arange(10), len(query) + 1)
+        inserted = _insert(number.repeat(len(places)), length.repeat(len(places)), places, digits)
+        substituted = _insert(deleted.repeat(10), deleted_lengths.repeat(10), places[:-10], digits[:-10])
+        swaps = np.array([int(query[:i] + query[i + 1] + query[i] + query[i + 2:]) for i in range(len(query) - 1)],
+                         dtype=np.int64)
+        values = np.concatenate([deleted, inserted, substituted, swaps])
+        lengths = np.concatenate([deleted_lengths, np.full(len(inserted), len(query) + 1),
+                                  np.full(len(substituted) + len(swaps), len(query))])
+        # A swap followed by an edit inside the swapped pair is three edits
+        # under optimal string alignment, so matches reached through a swap
+        # are checked like moves.
+        exact = np.arange(len(values)) < len(values) - len(swaps)
+        usable = lengths <= MAX_DIGITS
+        candidates, certain = self._within_one(values[usable], lengths[usable], exact[usable])
+
+        # Certain candidates are within two edits of query; the rest may
+        # be three and are checked.
+        order = np.argsort(np.abs(candidates - int(query)), kind="stable")
+        suggestions = []
+        for candidate, known in zip(candidates[order].tolist(), certain[order].tolist()):
+            candidate = str(candidate)
+            if candidate != query and (known or edit_distance(query, candidate, 2) <= 2):
+                suggestions.append(candidate)
+                if len(suggestions) == limit:
+                    break
+        return suggestions
+
+    def suggest(self, application_number, max_distance=2, limit=3):
+        """Up to limit stored numbers within max_distance (1 or 2) edits of
+        application_number, a canonical key: closest first, ties broken by
+        numeric closeness and then by the lower number.
+
+        Numbers two edits away are only looked for when none is one edit
+        away; that search probes the index about a thousand times rather
+        than a dozen.
+        """
+        query = application_number
+        if not query.isdigit() or len(query) > MAX_DIGITS or limit <= 0 or max_distance < 1:
+            return []
+
+        found = self._nearby(query)
+        closest = sorted(found, key=lambda candidate: (abs(int(candidate) - int(query)), int(candidate)))
+        suggestions = [candidate for candidate in closest if found[candidate] == 1][:limit]
+        if suggestions or max_distance < 2:
+            return suggestions
+        return self._two_away(query, limit)
+
+
+def fingerprint(numbers):
+    """Identifies the numbers an index file was built from."""
+    numbers = np.ascontiguousarray(numbers, dtype="<i8")
+    return {"count": len(numbers), "crc32": zlib.crc32(numbers)}
+
+
+def write_index(index, path):
+    """Atomically write index to path, for read_index in every worker."""
+    keys = np.ascontiguousarray(index.keys, dtype="<i8")
+    entries = np.ascontiguousarray(index.entries, dtype="u1")
+    header = json.dumps({"numbers": fingerprint(index.numbers), "count": len(keys)}).encode()
+    header += b" " * (-(INDEX_PREAMBLE.size + len(header)) % 8)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".visa-snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(INDEX_PREAMBLE.pack(INDEX_MAGIC, INDEX_VERSION, len(header)))
+            file.write(header)
+            file.write(keys.tobytes())
+            file.write(entries.tobytes())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    logger.info(f"Wrote near-match index {path} ({len(keys)} keys)")
+
+
+def read_index(path, numbers):
+    """The index at path, memory-mapped, if it was built from numbers;
+    otherwise None."""
+    try:
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    try:
+        magic, version, header_len = INDEX_PREAMBLE.unpack_from(mapped)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            return None
+        offset = INDEX_PREAMBLE.size
+        header = json.loads(mapped[offset:offset + header_len])
+        if header["numbers"] != fingerprint(numbers):
+            return None
+        offset += header_len
+        count = header["count"]
+        keys = np.frombuffer(mapped, dtype="<i8", count=count, offset=offset)
+        entries = np.frombuffer(mapped, dtype="u1", count=count, offset=offset + 8 * count)
+    except (struct.error, ValueError, KeyError):
+        return None
+    return NearMatchIndex(numbers, keys, entries)
@@ -0,0 +1,177 @@
+"""Range and prefix questions about application numbers.
+
+Application numbers are issued in sequence, so "how far have decisions
+got in my range?" is a question about a contiguous stretch of the sorted
+numbers an ArrayStore already keeps. DecisionRanges adds a running count
+of each status next to them: the decisions in any range are then two
+binary searches and a subtraction, however many numbers it covers.
+
+The counts take 4 bytes per number and status, so like the near-match
+index they are written to a file next to the shared snapshot (see
+write_ranges) and every worker maps the same pages read-only.
+
+Ranges file layout (little endian):
+
+    8 bytes   magic  b"VISARANG"
+    4 bytes   format version
+    4 bytes   length of the JSON header that follows
+    N bytes   JSON header (fingerprint of the numbers and status codes,
+              statuses, number count, counter dtype), padded with spaces
+              to an 8 byte boundary
+    ...       decided_before, statuses x (count + 1) counters, row major
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+from application_numbers import MAX_DIGITS, MAX_NUMBER
+from visa_store import STATUSES
+
+logger = logging.getLogger(__name__)
+
+RANGES_MAGIC = b"VISARANG"
+RANGES_VERSION = 1
+RANGES_PREAMBLE = struct.Struct("<8sII")
+
+
+def prefix_spans(prefix):
+    """The (first, last) ranges of application numbers whose digits start
+    with prefix, a string of digits: one range per possible length."""
+    if not prefix.isdigit() or not prefix.isascii() or len(prefix) > MAX_DIGITS:
+        return []
+    if prefix.startswith("0"):
+        # Canonical numbers have no leading zeros; only 0 itself starts with one.
+        return [(0, 0)] if prefix == "0" else []
+    value = int(prefix)
+    return [(value * 10 ** extra, (value + 1) * 10 ** extra - 1) for extra in range(MAX_DIGITS - len(prefix) + 1)]
+
+
+class DecisionRanges:
+    """Decisions per status between any two application numbers, from the
+    sorted int64 numbers and parallel status codes of an ArrayStore."""
+
+    def __init__(self, numbers, decided_before, statuses=STATUSES):
+        self.numbers = np.asarray(numbers, dtype=np.int64)
+        self.statuses = tuple(statuses)
+        # decided_before[code, i]: numbers with that status code among the first i.
+        self.decided_before = decided_before
+        self._numbers = memoryview(self.numbers)
+
+    @classmethod
+    def build(cls, numbers, codes, statuses=STATUSES):
+        codes = np.asarray(codes)
+        counter = np.int32 if len(numbers) < 2 ** 31 else np.int64
+        decided_before = np.zeros((len(statuses), len(numbers) + 1), dtype=counter)
+        for code in range(len(statuses)):
+            np.cumsum(codes == code, out=decided_before[code, 1:])
+        return cls(numbers, decided_before, statuses)
+
+    @classmethod
+    def from_store(cls, store):
+        return cls.build(getattr(store, "numbers", np.empty(0, dtype=np.int64)),
+                         getattr(store, "codes", np.empty(0, dtype=np.uint8)),
+                         getattr(store, "statuses", STATUSES))
+
+    @property
+    def nbytes(self):
+        return self.decided_before.nbytes
+
+    def _span(self, first, last):
+        return bisect_left(self._numbers, first), bisect_right(self._numbers, last)
+
+    def status_counts(self, first=0, last=MAX_NUMBER):
+        """{status: decisions} for the numbers from first to last inclusive."""
+        start, end = self._span(first, last)
+        counts = self.decided_before[:, end] - self.decided_before[:, start]
+        return dict(zip(self.statuses, counts.tolist()))
+
+    def count(self, first=0, last=MAX_NUMBER):
+        start, end = self._span(first, last)
+        return end - start
+
+    def highest_decided(self, first=0, last=MAX_NUMBER):
+        """The highest number from first to last with a decision, or None."""
+        start, end = self._span(first, last)
+        return self.numbers[end - 1].item() if end > start else None
+
+    def summary(self, spans):
+        """Decisions across the (first, last) ranges in spans, which must
+        not overlap, as a dict ready for JSON."""
+        firsts, lasts = np.array(spans, dtype=np.int64).reshape(-1, 2).T
+        starts = np.searchsorted(self.numbers, firsts, side="left")
+        ends = np.searchsorted(self.numbers, lasts, side="right")
+        counts = (self.decided_before[:, ends] - self.decided_before[:, starts]).sum(axis=1)
+        statuses = dict(zip(self.statuses, counts.tolist()))
+        decided, approved = sum(statuses.values()), statuses.get("Approved")
+        nonempty = ends > starts
+        return {
+            "decided": decided,
+            "statuses": statuses,
+            "approval_ratio": round(approved / decided, 4) if decided and approved is not None else None,
+            "lowest_decided": self.numbers[starts[nonempty]].min().item() if nonempty.any() else None,
+            "highest_decided": self.numbers[ends[nonempty] - 1].max().item() if nonempty.any() else None,
+        }
+
+
+def fingerprint(numbers, codes):
+    """Identifies the numbers and status codes a ranges file was built from."""
+    crc = zlib.crc32(np.ascontiguousarray(numbers, dtype="<i8"))
+    return {"count": len(numbers), "crc32": zlib.crc32(np.ascontiguousarray(codes, dtype="u1"), crc)}
+
+
+def write_ranges(ranges, path, codes):
+    """Atomically write ranges, built from codes, to path for read_ranges
+    in every worker."""
+    counter = ranges.decided_before.dtype.newbyteorder("<")
+    header = json.dumps({
+        "numbers": fingerprint(ranges.numbers, codes),
+        "statuses": ranges.statuses,
+        "count": len(ranges.numbers),
+        "dtype": counter.str,
+    }).encode()
+    header += b" " * (-(RANGES_PREAMBLE.size + len(header)) % 8)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".visa-snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(RANGES_PREAMBLE.pack(RANGES_MAGIC, RANGES_VERSION, len(header)))
+            file.write(header)
+            file.write(np.ascontiguousarray(ranges.decided_before, dtype=counter).tobytes())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    logger.info(f"Wrote decision ranges {path} ({len(ranges.numbers)} numbers)")
+
+
+def read_ranges(path, numbers, codes, statuses=STATUSES):
+    """The ranges at path, memory-mapped, if they were built from numbers
+    and codes; otherwise None."""
+    try:
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    try:
+        magic, version, header_len = RANGES_PREAMBLE.unpack_from(mapped)
+        if magic != RANGES_MAGIC or version != RANGES_VERSION:
+            return None
+        offset = RANGES_PREAMBLE.size
+        header = json.loads(mapped[offset:offset + header_len])
+        if header["numbers"] != fingerprint(numbers, codes) or tuple(header["statuses"]) != tuple(statuses):
+            return None
+        shape = (len(statuses), header["count"] + 1)
+        decided_before = np.frombuffer(
+            mapped, dtype=header["dtype"], count=shape[0] * shape[1], offset=offset + header_len).reshape(shape)
+    except (struct.error, ValueError, KeyError, TypeError):
+        return None
+    return DecisionRanges(numbers, decided_before, statuses)
@@ -95,7 +95,8 @@ document.getElementById('status-form').addEventListener('submit', async function
                 <h2>Visa Application Status: ${data.status}</h2>
                 <p>Working days since application: ${data.working_days}</p>
                 <p>${data.message}</p>
-                <p>Email notification: ${data.email_sent ? 'Sent successfully' : 'Failed to send'}</p>
+                ${data.suggestions && data.suggestions.length ? `<p>Did you mean ${data.suggestions.join(', ')}?</p>` : ''}
+                <p>Email notification: ${{queued: 'Queued for delivery', duplicate: 'Already sent recently, not sent again'}[data.email_status] || 'Failed to send'}</p>
             `;
         }
         if (data.email_error) {
@@ -0,0 +1,96 @@
+"""Status-change subscriptions.
+
+Applicants who opt in on /check_status are emailed when their
+application's status changes, instead of having to keep checking. Each
+subscription remembers the last status its subscriber was told about;
+after a reload, only subscriptions whose application now has a different
+status get a notification.
+"""
+import logging
+import time
+
+from email_outbox import PRIORITY_STATUS_CHANGE
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionStore:
+    """application_number -> subscribed emails, kept in the outbox database.
+
+    Sharing the outbox's file lets a fan-out queue its emails and record
+    what it told each subscriber in one transaction. Every worker may run
+    the same fan-out after a reload; the first one to commit sends the
+    emails and the rest find nothing left to send.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS subscriptions ("
+        " application_number TEXT NOT NULL, email TEXT NOT NULL, status TEXT, subscribed_at REAL NOT NULL,"
+        " PRIMARY KEY (application_number, email)) WITHOUT ROWID",
+    )
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+        connection = outbox.connection()
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+
+    def subscribe(self, application_number, email, status):
+        """Watch application_number for email; status (None if not found)
+        is what the subscriber already knows."""
+        self.outbox.connection().execute(
+            "INSERT OR REPLACE INTO subscriptions VALUES (?, ?, ?, ?)",
+            (application_number, email.strip().lower(), status, time.time()))
+
+    def unsubscribe(self, application_number, email):
+        self.outbox.connection().execute(
+            "DELETE FROM subscriptions WHERE application_number = ? AND email = ?",
+            (application_number, email.strip().lower()))
+
+    def __len__(self):
+        return self.outbox.connection().execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0]
+
+    def subscribed_numbers(self):
+        return [number for (number,) in self.outbox.connection().execute(
+            "SELECT DISTINCT application_number FROM subscriptions")]
+
+    def fan_out(self, statuses, message):
+        """Email every subscriber whose application's status differs from
+        what they were last told.
+
+        statuses is an iterable of (application_number, status or None);
+        message(application_number, status, email) returns (subject, body).
+        Returns the number of emails queued.
+        """
+        connection = self.outbox.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS current_status ("
+                " application_number TEXT PRIMARY KEY, status TEXT) WITHOUT ROWID")
+            connection.execute("DELETE FROM current_status")
+            connection.executemany("INSERT OR REPLACE INTO current_status VALUES (?, ?)", statuses)
+            stale = connection.execute(
+                "SELECT s.application_number, s.email, c.status FROM subscriptions s"
+                " JOIN current_status c ON c.application_number = s.application_number"
+                " WHERE s.status IS NOT c.status").fetchall()
+            emails = []
+            for application_number, email, status in stale:
+                # A decision that disappeared is noted silently; the email
+                # goes out if it comes back.
+                if status is not None:
+                    subject, body = message(application_number, status, email)
+                    emails.append((email, subject, body))
+            self.outbox.enqueue_many(emails, PRIORITY_STATUS_CHANGE, digest=True)
+            connection.execute(
+                "UPDATE subscriptions SET status = (SELECT c.status FROM current_status c"
+                " WHERE c.application_number = subscriptions.application_number)"
+                " WHERE application_number IN (SELECT application_number FROM current_status)")
+            connection.execute("DELETE FROM current_status")
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if emails:
+            logger.info(f"Queued {len(emails)} status change notifications")
+        return len(emails)
@@ -0,0 +1,123 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from application_numbers import MAX_NUMBER, canonical_key, canonical_number, canonical_numbers
+from bench import process_dataframe, process_visa_row
+from visa_ingest import process_decision_rows
+from visa_store import ArrayStore, FilteredStore, BloomFilter, SQLiteStore, lookup_statuses
+
+
+def random_spelling(rng, number):
+    """number as one of the forms the decision sheets and forms produce."""
+    return rng.choice([
+        lambda: number,
+        lambda: float(number) if number < 2 ** 53 else number,
+        lambda: str(number),
+        lambda: f"{number}.0",
+        lambda: f"  {number}\t",
+        lambda: "0" * rng.randrange(1, 4) + str(number),
+        lambda: f"{number}.{'0' * rng.randrange(1, 3)}",
+        lambda: np.int64(number),
+    ])()
+
+
+def random_value(rng):
+    """Anything a client or a spreadsheet cell might hand over."""
+    number = rng.choice([rng.randrange(10 ** 8), rng.randrange(10 ** 16, 10 ** 18), rng.randrange(MAX_NUMBER + 2)])
+    return rng.choice([
+        lambda: random_spelling(rng, number),
+        lambda: -number - 1,
+        lambda: number + 0.5,
+        lambda: float(10 ** rng.randrange(15, 20)),
+        lambda: rng.choice([float("nan"), float("inf"), -0.0, 1e300]),
+        lambda: rng.choice([True, False, None, "", " ", ".", "0", "00", "1e+16", "1.5", "12a", "-3", "+3"]),
+        lambda: "".join(rng.choice("0123456789 .e-") for _ in range(rng.randrange(1, 12))),
+        lambda: "٤٨" + str(number),
+    ])()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_vectorized_form_agrees_with_canonical_number(seed):
+    rng = random.Random(seed)
+    values = [random_value(rng) for _ in range(2000)]
+    numbers, valid = canonical_numbers(values)
+    expected = [canonical_number(value) for value in values]
+    assert valid.tolist() == [number is not None for number in expected]
+    assert numbers[valid].tolist() == [number for number in expected if number is not None]
+
+
+def test_float_arrays_agree_with_canonical_number():
+    values = np.array([1e16, 48056052.0, 1e18, 1e17 + 8, 0.5, -2.0, np.nan])
+    numbers, valid = canonical_numbers(values)
+    expected = [canonical_number(value) for value in values.tolist()]
+    assert valid.tolist() == [number is not None for number in expected]
+    assert numbers[valid].tolist() == [number for number in expected if number is not None]
+
+
+@pytest.mark.parametrize("value", [48056052, 48056052.0, "48056052", " 048056052 ", "48056052.00", np.int64(48056052)])
+def test_spellings_share_one_key(value):
+    assert canonical_key(value) == "48056052"
+
+
+def random_sheet(rng, rows):
+    numbers = [rng.randrange(10 ** 7, 10 ** 7 + rows) for _ in range(rows)]
+    cells = [random_spelling(rng, number) for number in numbers]
+    decisions = [rng.choice(["Approved", " refused ", "APPROVED", "Pending", None]) for _ in range(rows)]
+    return numbers, cells, decisions
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_ingest_paths_agree(seed):
+    rng = random.Random(seed)
+    _, cells, decisions = random_sheet(rng, 1500)
+    frame = pd.DataFrame({0: None, 1: None, 2: pd.Series(cells, dtype=object), 3: decisions})
+
+    from_frame = process_dataframe(frame)
+    rows = [process_visa_row(row) for row in frame.itertuples(index=False)]
+    from_rows = {}
+    for application_number, visa_info in rows:
+        if application_number is not None:
+            from_rows.setdefault(application_number, visa_info)
+    from_stream = process_decision_rows(
+        (str(cell), decision) for cell, decision in zip(cells, decisions) if decision is not None)
+
+    assert from_frame == from_rows
+    assert from_stream == from_rows
+
+
+@pytest.fixture(params=["array", "filtered", "sqlite", "dict"])
+def make_store(request, tmp_path):
+    def make(visa_database):
+        array = ArrayStore.from_mapping(visa_database)
+        if request.param == "array":
+            return array
+        if request.param == "filtered":
+            return FilteredStore(array, BloomFilter.from_store(array))
+        if request.param == "sqlite":
+            store = SQLiteStore(str(tmp_path / "decisions.sqlite"))
+            store.sync(array, 1)
+            return store
+        return dict(visa_database)
+    return make
+
+
+@pytest.mark.parametrize("seed", range(2))
+def test_lookups_find_what_ingest_stored(seed, make_store):
+    rng = random.Random(seed)
+    numbers, cells, decisions = random_sheet(rng, 800)
+    frame = pd.DataFrame({0: None, 1: None, 2: pd.Series(cells, dtype=object), 3: decisions})
+    visa_database = process_dataframe(frame)
+    store = make_store(visa_database)
+
+    queries = [random_spelling(rng, number) for number in numbers] + [rng.randrange(10 ** 9) for _ in range(200)]
+    expected = [visa_database.get(canonical_key(query), {}).get("status", "Not Found") for query in queries]
+
+    # /check_status: one key at a time.
+    assert [store.get(canonical_key(query), {"status": "Not Found"})["status"] for query in queries] == expected
+    # /check_status_batch and /bulk_check: the whole batch at once.
+    batch, valid = canonical_numbers(queries)
+    assert valid.all()
+    assert lookup_statuses(store, batch, "Not Found").tolist() == expected
@@ -0,0 +1,99 @@
+import random
+
+import numpy as np
+import pytest
+
+from near_match import NearMatchIndex, edit_distance, read_index, write_index
+
+
+def typo(rng, digits):
+    """digits with one random slip: a wrong, missing, extra or swapped
+    digit, or two wrong digits."""
+    digits = list(digits)
+    position = rng.randrange(len(digits))
+    slip = rng.randrange(5)
+    if slip == 0:
+        digits[position] = str((int(digits[position]) + 1) % 10)
+    elif slip == 1 and len(digits) > 1:
+        del digits[position]
+    elif slip == 2:
+        digits.insert(position, str(rng.randrange(10)))
+    elif slip == 3 and position + 1 < len(digits):
+        digits[position], digits[position + 1] = digits[position + 1], digits[position]
+    else:
+        digits[position] = str(rng.randrange(10))
+        digits[rng.randrange(len(digits))] = str(rng.randrange(10))
+    return "".join(digits).lstrip("0") or "0"
+
+
+def reference_distance(a, b):
+    """Optimal string alignment distance, the textbook full table."""
+    table = [[i + j if i * j == 0 else 0 for j in range(len(b) + 1)] for i in range(len(a) + 1)]
+    for i in range(1, len(a) + 1):
+        for j in range(1, len(b) + 1):
+            table[i][j] = min(table[i - 1][j] + 1, table[i][j - 1] + 1,
+                              table[i - 1][j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                table[i][j] = min(table[i][j], table[i - 2][j - 2] + 1)
+    return table[-1][-1]
+
+
+def test_edit_distance_matches_reference():
+    rng = random.Random(0)
+    for _ in range(3000):
+        a = str(rng.randrange(10 ** rng.randrange(1, 9)))
+        b = typo(rng, typo(rng, a)) if rng.random() < 0.7 else str(rng.randrange(10 ** 8))
+        for limit in (1, 2, 3):
+            assert edit_distance(a, b, limit) == min(reference_distance(a, b), limit + 1), (a, b, limit)
+
+
+def brute_force_suggestions(numbers, query, max_distance):
+    distances = {number: edit_distance(query, number, 2) for number in numbers}
+
+    def closest_first(distance):
+        candidates = [number for number in numbers if distances[number] == distance]
+        return sorted(candidates, key=lambda number: (abs(int(number) - int(query)), int(number)))
+
+    one_away = closest_first(1)
+    if one_away or max_distance < 2:
+        return one_away
+    return closest_first(2)
+
+
+# Sparse sets, where most typos have no neighbour, and a dense stretch,
+# where most have several.
+@pytest.mark.parametrize("low, high, size, seed", [
+    (10 ** 5, 10 ** 6, 30, 0),
+    (10 ** 5, 10 ** 6, 1000, 1),
+    (20000, 22000, 1000, 2),
+])
+def test_suggestions_match_brute_force(low, high, size, seed):
+    rng = random.Random(seed)
+    numbers = np.unique(np.concatenate([
+        np.random.default_rng(seed).integers(low, high, size), [0, 7, 10, 11, 100]]))
+    stored = numbers.astype(str).tolist()
+    index = NearMatchIndex.build(numbers)
+
+    queries = [typo(rng, rng.choice(stored)) for _ in range(100)]
+    queries += [str(rng.randrange(high)) for _ in range(20)] + ["0", "1", "9", "99"]
+    for query in queries:
+        if query in stored:
+            continue
+        for max_distance in (1, 2):
+            expected = brute_force_suggestions(stored, query, max_distance)
+            assert index.suggest(query, max_distance, limit=len(stored)) == expected, (query, max_distance)
+
+
+def test_index_file_round_trip(tmp_path):
+    numbers = np.unique(np.random.default_rng(3).integers(10 ** 7, 10 ** 8, 5000))
+    path = str(tmp_path / "numbers.near")
+    index = NearMatchIndex.build(numbers)
+    write_index(index, path)
+
+    mapped = read_index(path, numbers)
+    assert mapped is not None
+    assert np.array_equal(mapped.keys, index.keys) and np.array_equal(mapped.entries, index.entries)
+    query = str(numbers[17] + 1)
+    assert mapped.suggest(query, 2) == index.suggest(query, 2)
+    # An index built from other numbers is not used.
+    assert read_index(path, numbers[:-1]) is None
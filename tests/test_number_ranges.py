@@ -0,0 +1,47 @@
+import random
+
+import numpy as np
+import pytest
+
+from number_ranges import DecisionRanges, prefix_spans, read_ranges, write_ranges
+from visa_store import ArrayStore, STATUSES
+
+
+@pytest.fixture(scope="module")
+def store():
+    rng = np.random.default_rng(0)
+    numbers = np.unique(rng.integers(10 ** 6, 10 ** 8, 20000))
+    return ArrayStore(numbers, (rng.random(len(numbers)) < 0.1).astype(np.uint8))
+
+
+def test_summary_matches_a_scan(store):
+    ranges = DecisionRanges.from_store(store)
+    rng = random.Random(1)
+    for _ in range(200):
+        first, last = sorted(rng.randrange(10 ** 8) for _ in range(2))
+        inside = (store.numbers >= first) & (store.numbers <= last)
+        summary = ranges.summary([(first, last)])
+        expected = {status: int((store.codes[inside] == code).sum()) for code, status in enumerate(STATUSES)}
+        assert summary["statuses"] == expected
+        assert summary["decided"] == inside.sum()
+        assert summary["highest_decided"] == (store.numbers[inside].max() if inside.any() else None)
+
+
+def test_prefix_spans_cover_numbers_with_that_prefix(store):
+    ranges = DecisionRanges.from_store(store)
+    expected = sum(str(number).startswith("42") for number in store.numbers.tolist())
+    assert ranges.summary(prefix_spans("42"))["decided"] == expected
+
+
+def test_ranges_file_round_trip(store, tmp_path):
+    path = str(tmp_path / "numbers.ranges")
+    ranges = DecisionRanges.from_store(store)
+    write_ranges(ranges, path, store.codes)
+
+    mapped = read_ranges(path, store.numbers, store.codes)
+    assert mapped is not None
+    assert np.array_equal(mapped.decided_before, ranges.decided_before)
+    assert mapped.summary([(0, 5 * 10 ** 7)]) == ranges.summary([(0, 5 * 10 ** 7)])
+    # Ranges built from other numbers or other decisions are not used.
+    assert read_ranges(path, store.numbers[:-1], store.codes[:-1]) is None
+    assert read_ranges(path, store.numbers, 1 - store.codes) is None
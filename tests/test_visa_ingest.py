@@ -0,0 +1,113 @@
+import random
+import zipfile
+
+import pytest
+
+from visa_ingest import OdsDecisionReader, WatermarkMismatch, compile_visa_database, process_decision_rows
+from visa_store import open_snapshot
+
+CELL = '<table:table-cell office:value-type="string"><text:p>{}</text:p></table:table-cell>'
+
+
+def write_decisions(path, rows, period="01/01/2024 to 17/10/2024"):
+    """Write an ODS laid out like the published decisions report: title
+    rows naming the reporting period, a header, then one row per
+    (application number, decision)."""
+    def row(*cells):
+        return f'<table:table-row><table:table-cell table:number-columns-repeated="2"/>{"".join(cells)}</table:table-row>'
+
+    content = [
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<office:document-content'
+        ' xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"'
+        ' xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0"'
+        ' xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0">'
+        '<office:body><office:spreadsheet><table:table table:name="ApplicationDecisionReport">',
+        row(CELL.format("Application Decisions:")),
+        row(CELL.format(f"Decisions for period from {period}")),
+        row(CELL.format("Application Number"), CELL.format("Decision")),
+    ]
+    for number, decision in rows:
+        content.append(row(
+            f'<table:table-cell office:value-type="float" office:value="{number}"><text:p>{number}</text:p></table:table-cell>',
+            CELL.format(decision)))
+    content.append(
+        '<table:table-row table:number-rows-repeated="1000">'
+        '<table:table-cell table:number-columns-repeated="16384"/></table:table-row>'
+        '</table:table></office:spreadsheet></office:body></office:document-content>')
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("mimetype", "application/vnd.oasis.opendocument.spreadsheet")
+        archive.writestr("content.xml", "".join(content))
+
+
+def random_decisions(rng, count):
+    return [(rng.randrange(40_000_000, 40_000_000 + 2 * count), rng.choice(["Approved", "Refused"]))
+            for _ in range(count)]
+
+
+def full_parse(path):
+    return process_decision_rows(OdsDecisionReader(path))
+
+
+@pytest.mark.parametrize("chunk_size", [7, 100, 1 << 16])
+def test_resuming_after_appended_rows_matches_a_full_parse(tmp_path, chunk_size):
+    rng = random.Random(chunk_size)
+    path = str(tmp_path / "decisions.ods")
+    rows = random_decisions(rng, 300)
+    write_decisions(path, rows)
+    first = OdsDecisionReader(path, chunk_size=chunk_size)
+    process_decision_rows(first)
+
+    # The next export has a new reporting period and more rows, some of
+    # them repeating numbers already decided.
+    appended = random_decisions(rng, 50)
+    write_decisions(path, rows + appended, period="01/01/2024 to 24/10/2024")
+    resumed = OdsDecisionReader(path, resume_from=first.watermark, chunk_size=chunk_size)
+    assert list(resumed) == [(str(number), decision) for number, decision in appended]
+    assert resumed.watermark["rows"] == first.watermark["rows"] + len(appended)
+
+    # The resumed watermark works for the next export in turn.
+    more = random_decisions(rng, 20)
+    write_decisions(path, rows + appended + more)
+    again = OdsDecisionReader(path, resume_from=resumed.watermark, chunk_size=chunk_size)
+    assert list(again) == [(str(number), decision) for number, decision in more]
+
+
+def test_incremental_compile_matches_a_full_parse(tmp_path):
+    rng = random.Random(1)
+    path = str(tmp_path / "decisions.ods")
+    rows = random_decisions(rng, 400)
+    write_decisions(path, rows)
+    compile_visa_database(path)
+
+    write_decisions(path, rows + random_decisions(rng, 100))
+    merged = compile_visa_database(path, previous=open_snapshot(path))
+    assert dict(merged) == full_parse(path)
+    assert open_snapshot(path).watermark["rows"] == 3 + 500
+
+
+@pytest.mark.parametrize("edit", ["decision", "number", "inserted", "removed"])
+def test_earlier_rows_changing_forces_a_full_rebuild(tmp_path, edit):
+    rng = random.Random(2)
+    path = str(tmp_path / "decisions.ods")
+    rows = random_decisions(rng, 200)
+    write_decisions(path, rows)
+    compile_visa_database(path)
+    watermark = open_snapshot(path).watermark
+
+    number, decision = rows[10]
+    edited = list(rows)
+    if edit == "decision":
+        edited[10] = (number, "Refused" if decision == "Approved" else "Approved")
+    elif edit == "number":
+        edited[10] = (number + 1, decision)
+    elif edit == "inserted":
+        edited.insert(10, (number + 1, decision))
+    else:
+        del edited[10]
+    write_decisions(path, edited + random_decisions(rng, 30))
+
+    with pytest.raises(WatermarkMismatch):
+        list(OdsDecisionReader(path, resume_from=watermark))
+    rebuilt = compile_visa_database(path, previous=open_snapshot(path))
+    assert dict(rebuilt) == full_parse(path)
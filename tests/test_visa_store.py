@@ -0,0 +1,23 @@
+from visa_store import ArrayStore, SQLiteStore
+
+
+def test_sqlite_sync_rewrites_new_content_under_a_reused_generation(tmp_path):
+    store = SQLiteStore(str(tmp_path / "decisions.sqlite"))
+    assert store.sync(ArrayStore.from_mapping({"1": {"status": "Refused"}}), 1)
+
+    # A rebuilt shared snapshot starts counting generations from 1 again.
+    new = ArrayStore.from_mapping({"1": {"status": "Approved"}, "2": {"status": "Refused"}})
+    assert store.sync(new, 1)
+    assert store["1"]["status"] == "Approved"
+    assert store["2"]["status"] == "Refused"
+
+
+def test_sqlite_sync_skips_unchanged_content(tmp_path):
+    path = str(tmp_path / "decisions.sqlite")
+    content = ArrayStore.from_mapping({"7": {"status": "Approved"}})
+    assert SQLiteStore(path).sync(content, 1)
+
+    restarted = SQLiteStore(path)
+    assert not restarted.sync(content, 2)
+    assert restarted.generation == 2
+    assert dict(restarted) == {"7": {"status": "Approved", "application_date": "2024-01-01"}}
@@ -0,0 +1,96 @@
+import random
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pytest
+
+from working_days import WorkingDayCalendar, irish_public_holidays, parse_closures
+
+CLOSURES = parse_closures("2023-12-27..2023-12-29, 2024-07-15")
+
+
+def loop_working_days(start, end, closed):
+    """The day-by-day loop check_status used before WorkingDayCalendar."""
+    working_days = 0
+    current = start
+    while current <= end:
+        day = current.date() if isinstance(current, datetime) else current
+        if current.weekday() < 5 and day not in closed:
+            working_days += 1
+        current += timedelta(days=1)
+    return working_days
+
+
+@pytest.fixture(scope="module")
+def calendar():
+    return WorkingDayCalendar.ireland(CLOSURES)
+
+
+@pytest.fixture(scope="module")
+def closed():
+    return {day for year in range(1990, 2101) for day in irish_public_holidays(year)} | set(CLOSURES)
+
+
+def random_dates(rng, count):
+    first = date(2015, 1, 1).toordinal()
+    for _ in range(count):
+        start = date.fromordinal(first + rng.randrange(4000))
+        yield start, start + timedelta(days=rng.randrange(-30, 800))
+
+
+def test_count_matches_loop_on_dates(calendar, closed):
+    rng = random.Random(18)
+    for start, end in random_dates(rng, 500):
+        assert calendar.count(start, end) == loop_working_days(start, end, closed), (start, end)
+
+
+def test_count_matches_loop_on_datetimes(calendar, closed):
+    rng = random.Random(1018)
+    for start, end in random_dates(rng, 500):
+        start = datetime.combine(start, datetime.min.time()) + timedelta(seconds=rng.randrange(86400))
+        end = datetime.combine(end, datetime.min.time()) + timedelta(seconds=rng.randrange(86400))
+        assert calendar.count(start, end) == loop_working_days(start, end, closed), (start, end)
+
+
+def test_count_many_matches_loop(calendar, closed):
+    rng = random.Random(2018)
+    end = date(2026, 3, 2)
+    starts = [end - timedelta(days=rng.randrange(-20, 2000)) for _ in range(500)]
+    expected = [loop_working_days(start, end, closed) for start in starts]
+    assert calendar.count_many(starts, end).tolist() == expected
+    assert calendar.count_many(np.array(starts, dtype="datetime64[D]"), np.datetime64(end)).tolist() == expected
+
+
+def test_count_many_with_one_end_per_start(calendar, closed):
+    rng = random.Random(3018)
+    pairs = list(random_dates(rng, 300))
+    starts, ends = zip(*pairs)
+    assert calendar.count_many(list(starts), list(ends)).tolist() == [
+        loop_working_days(start, end, closed) for start, end in pairs]
+
+
+@pytest.mark.parametrize("year, holidays", [
+    (2021, ["2021-01-01", "2021-03-17", "2021-04-05", "2021-05-03", "2021-06-07", "2021-08-02",
+            "2021-10-25", "2021-12-27", "2021-12-28"]),
+    (2022, ["2022-01-03", "2022-03-17", "2022-03-18", "2022-04-18", "2022-05-02", "2022-06-06",
+            "2022-08-01", "2022-10-31", "2022-12-26", "2022-12-27"]),
+    (2024, ["2024-01-01", "2024-02-05", "2024-03-18", "2024-04-01", "2024-05-06", "2024-06-03",
+            "2024-08-05", "2024-10-28", "2024-12-25", "2024-12-26"]),
+])
+def test_known_holiday_years(year, holidays):
+    assert irish_public_holidays(year) == [date.fromisoformat(day) for day in holidays]
+    calendar = WorkingDayCalendar.ireland()
+    weekdays = loop_working_days(date(year, 1, 1), date(year, 12, 31), set())
+    assert calendar.count(date(year, 1, 1), date(year, 12, 31)) == weekdays - len(holidays)
+
+
+def test_ranges_outside_the_table_count_weekdays(closed):
+    calendar = WorkingDayCalendar.ireland(first_year=2020, last_year=2021)
+    start, end = date(2019, 12, 2), date(2022, 1, 31)
+    inside = {day for day in closed if day.year in (2020, 2021) and day not in CLOSURES}
+    assert calendar.count(start, end) == loop_working_days(start, end, inside)
+
+
+def test_backwards_range_is_zero(calendar):
+    assert calendar.count(date(2024, 5, 2), date(2024, 5, 1)) == 0
+    assert calendar.count_many([date(2024, 5, 2)], date(2024, 5, 1)).tolist() == [0]
@@ -0,0 +1,320 @@
+"""Reading decision spreadsheets into the visa database.
+
+Everything here is free of import-time side effects (unlike app, which
+loads the database when imported), so it is safe to run in pool workers.
+"""
+import hashlib
+import logging
+import re
+import xml.parsers.expat
+import zipfile
+from itertools import chain
+
+from application_numbers import canonical_key
+from visa_store import ArrayStore, open_snapshot, snapshot_path_for, source_fingerprint, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+ODS_TABLE_NS = "urn:oasis:names:tc:opendocument:xmlns:table:1.0"
+ODS_OFFICE_NS = "urn:oasis:names:tc:opendocument:xmlns:office:1.0"
+ODS_TEXT_NS = "urn:oasis:names:tc:opendocument:xmlns:text:1.0"
+
+# expat reports namespaced names as "<uri> <local-name>"
+ODS_TABLE = f"{ODS_TABLE_NS} table"
+ODS_ROW = f"{ODS_TABLE_NS} table-row"
+ODS_CELLS = (f"{ODS_TABLE_NS} table-cell", f"{ODS_TABLE_NS} covered-table-cell")
+ODS_COLUMNS_REPEATED = f"{ODS_TABLE_NS} number-columns-repeated"
+ODS_VALUE_TYPE = f"{ODS_OFFICE_NS} value-type"
+ODS_PARAGRAPH = f"{ODS_TEXT_NS} p"
+ODS_SPACE = f"{ODS_TEXT_NS} s"
+
+
+class OdsDecisionParser:
+    """Incremental expat handler for the first sheet of an ODS content.xml.
+
+    Only the application number and decision columns are kept. Repeated
+    columns are skipped arithmetically and repeated rows are never expanded,
+    so memory stays flat however many (or however wide) the rows are.
+    """
+
+    def __init__(self, number_column=2, decision_column=3):
+        self.number_column = number_column
+        self.decision_column = decision_column
+        self.rows = []
+        self.done = False
+        # Rows started in the sheet, and (rows, byte offset) just past the
+        # last row that carried a decision; see OdsDecisionReader.
+        self.row_count = 0
+        self.watermark = None
+        self.first_decision_offset = None
+        self._after_decision = False
+        self._row_offset = None
+        self._tables = 0
+        self._column = 0
+        self._cell = None
+        self._text = None
+        self._values = {}
+
+        self.parser = xml.parsers.expat.ParserCreate(namespace_separator=" ")
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._characters
+
+    def feed(self, data, final=False):
+        self.parser.Parse(data, final)
+
+    def _mark(self):
+        self.watermark = (self.row_count, self.parser.CurrentByteIndex)
+        self._after_decision = False
+
+    def _start(self, name, attrs):
+        if self.done:
+            return
+        if self._after_decision:
+            self._mark()
+        if name == ODS_TABLE:
+            self._tables += 1
+        elif self._tables != 1:
+            return
+        elif name == ODS_ROW:
+            self.row_count += 1
+            self._row_offset = self.parser.CurrentByteIndex
+            self._column = 0
+            self._values = {}
+        elif name in ODS_CELLS:
+            repeat = int(attrs.get(ODS_COLUMNS_REPEATED, 1))
+            first = self._column
+            self._column += repeat
+            wanted = [column for column in (self.number_column, self.decision_column)
+                      if first <= column < self._column]
+            self._cell = (wanted, attrs) if wanted else None
+            self._text = None
+        elif name == ODS_PARAGRAPH and self._cell is not None:
+            if self._text is None:
+                self._text = []
+            else:
+                self._text.append("\n")
+        elif name == ODS_SPACE and self._text is not None:
+            self._text.append(" " * int(attrs.get(f"{ODS_TEXT_NS} c", 1)))
+
+    def _characters(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def _end(self, name):
+        if self.done or self._tables != 1:
+            return
+        if self._after_decision:
+            self._mark()
+        if name in ODS_CELLS:
+            if self._cell is not None:
+                wanted, attrs = self._cell
+                value = self._cell_value(attrs)
+                if value is not None:
+                    for column in wanted:
+                        self._values[column] = value
+                self._cell = None
+                self._text = None
+        elif name == ODS_ROW:
+            application_number = self._values.get(self.number_column)
+            decision = self._values.get(self.decision_column)
+            # number-rows-repeated is deliberately ignored: a repeated row is
+            # the same pair every time, which the consumer would discard
+            # after its first occurrence anyway.
+            if application_number is not None and decision is not None:
+                self.rows.append((application_number, decision))
+                self._after_decision = True
+                if self.first_decision_offset is None:
+                    self.first_decision_offset = self._row_offset
+        elif name == ODS_TABLE:
+            self.done = True
+
+    def _cell_value(self, attrs):
+        # Mirrors how pandas' odf engine turns a cell into a Python value
+        # before bench.process_visa_row stringifies it.
+        value_type = attrs.get(ODS_VALUE_TYPE)
+        if value_type in ("float", "percentage", "currency"):
+            number = float(attrs[f"{ODS_OFFICE_NS} value"])
+            return str(int(number)) if number.is_integer() else str(number)
+        if value_type == "boolean":
+            return str(attrs.get(f"{ODS_OFFICE_NS} boolean-value") == "true")
+        if value_type == "date":
+            return attrs.get(f"{ODS_OFFICE_NS} date-value")
+        if self._text is None:
+            return None
+        return "".join(self._text)
+
+
+class WatermarkMismatch(Exception):
+    """The sheet no longer starts with the rows a watermark was taken over."""
+
+
+# Start tags of rows and tables as spreadsheet exporters write them. Only
+# used while skipping to a watermark; a file using another namespace prefix
+# just fails the row count check and gets a full parse.
+ODS_ROW_TAG = re.compile(rb"<table:table-row[\s>/]")
+ODS_TABLE_TAG = re.compile(rb"<table:table[\s>]")
+
+
+class OdsDecisionReader:
+    """Iterate the (application_number, decision) pairs of an ODS file.
+
+    After iterating, ``watermark`` records how far the sheet was read: the
+    number of rows up to the last row with a decision, the byte offset just
+    past it in content.xml, and a hash of content.xml from the first
+    decision row up to that offset. The title rows above are left out
+    because their reporting period changes with every export. The weekly
+    decisions file only ever grows by appended rows, so a later reader
+    given ``resume_from=watermark`` re-checks the row count and hash and
+    then parses only what comes after. The earlier rows are decompressed
+    and hashed but never parsed. If they changed, iteration raises
+    WatermarkMismatch before yielding anything.
+    """
+
+    def __init__(self, file_path, resume_from=None, chunk_size=1 << 16, number_column=2, decision_column=3):
+        self.file_path = file_path
+        self.resume_from = resume_from
+        self.chunk_size = chunk_size
+        self.number_column = number_column
+        self.decision_column = decision_column
+        self.watermark = resume_from
+
+    def __iter__(self):
+        with zipfile.ZipFile(self.file_path) as archive, archive.open("content.xml") as content:
+            chunks = iter(lambda: content.read(self.chunk_size), b"")
+            handler = OdsDecisionParser(self.number_column, self.decision_column)
+            # Offsets reported by the parser are relative to what it was fed;
+            # fed_base maps them back to offsets in content.xml.
+            fed_base, rows_base = 0, 0
+            self._digest, self._hashed_to, self._pending = hashlib.sha256(), 0, bytearray()
+            self._start = None
+
+            if self.resume_from is not None:
+                context, rest = self._skip_to_watermark(chunks)
+                handler.feed(context)
+                fed_base = self.resume_from["offset"] - len(context)
+                rows_base = self.resume_from["rows"]
+                chunks = chain([rest], chunks)
+
+            for chunk in chain(chunks, [b""]):
+                self._pending += chunk
+                handler.feed(chunk, final=not chunk)
+                self._advance(handler, fed_base, rows_base)
+                yield from handler.rows
+                handler.rows.clear()
+                if handler.done:
+                    break
+
+    def _advance(self, handler, fed_base, rows_base):
+        if self._start is None and handler.first_decision_offset is not None:
+            # Everything before the first decision row stays out of the hash.
+            self._start = handler.first_decision_offset + fed_base
+            del self._pending[:self._start - self._hashed_to]
+            self._hashed_to = self._start
+        if handler.watermark is None:
+            return
+        rows, offset = handler.watermark
+        offset += fed_base
+        if offset <= self._hashed_to:
+            return
+        self._digest.update(self._pending[:offset - self._hashed_to])
+        del self._pending[:offset - self._hashed_to]
+        self._hashed_to = offset
+        self.watermark = {
+            "rows": rows_base + rows,
+            "offset": offset,
+            "start": self._start,
+            "sha256": self._digest.hexdigest(),
+        }
+
+    def _skip_to_watermark(self, chunks):
+        """Consume content.xml up to the watermark, verifying it on the way.
+
+        Returns the document prefix up to and including the first table's
+        start tag, which gives a fresh parser the namespaces and context it
+        needs, and the rest of the chunk the watermark fell in.
+        """
+        start, target = self.resume_from["start"], self.resume_from["offset"]
+        context, head = None, b""
+        rows, position, carry = 0, 0, b""
+        for chunk in chunks:
+            if context is None:
+                head += chunk
+                match = ODS_TABLE_TAG.search(head)
+                close = head.find(b">", match.end() - 1) if match else -1
+                if close >= 0:
+                    context, head = head[:close + 1], b""
+            end = min(len(chunk), target - position)
+            # The carry is shorter than a row tag, so no tag is counted twice.
+            scanned = carry + chunk[:end]
+            rows += len(ODS_ROW_TAG.findall(scanned))
+            carry = scanned[-16:]
+            if position + end > start:
+                self._digest.update(chunk[max(start - position, 0):end])
+            position += end
+            if position == target:
+                if (context is None or rows != self.resume_from["rows"]
+                        or self._digest.hexdigest() != self.resume_from["sha256"]):
+                    break
+                self._start, self._hashed_to = start, target
+                return context, chunk[end:]
+        raise WatermarkMismatch(f"{self.file_path} changed before row {self.resume_from['rows']}")
+
+
+def iter_ods_decisions(file_path, chunk_size=1 << 16):
+    """Yield (application_number, decision) pairs from an ODS file without loading it whole."""
+    return iter(OdsDecisionReader(file_path, chunk_size=chunk_size))
+
+
+def process_decision_rows(rows):
+    # Rows arrive top to bottom, so the first occurrence of an application
+    # number is the one kept.
+    visa_database = {}
+    for application_number, decision in rows:
+        application_number = canonical_key(application_number)
+        decision = decision.strip().lower()
+        if application_number and decision in ("approved", "refused") and application_number not in visa_database:
+            visa_database[application_number] = {"status": decision.capitalize(), "application_date": "2024-01-01"}
+    return visa_database
+
+
+def compile_visa_database(source_path, previous=None):
+    # Fingerprint before parsing so an edit made mid-parse leaves the
+    # snapshot stale rather than wrongly fresh.
+    fingerprint = source_fingerprint(source_path)
+    visa_database = None
+
+    if previous is not None and previous.watermark:
+        reader = OdsDecisionReader(source_path, resume_from=previous.watermark)
+        try:
+            additions = process_decision_rows(reader)
+            visa_database = previous.to_store().merged(additions)
+            logger.debug(f"Merged {len(additions)} new visa records appended to {source_path}")
+        except WatermarkMismatch as e:
+            logger.info(f"Full rebuild of visa database: {str(e)}")
+
+    if visa_database is None:
+        logger.debug(f"Streaming {source_path} file...")
+        reader = OdsDecisionReader(source_path)
+        visa_database = process_decision_rows(reader)
+
+    try:
+        write_snapshot(visa_database, snapshot_path_for(source_path), fingerprint, reader.watermark)
+    except OSError as e:
+        logger.warning(f"Could not write visa snapshot for {source_path}: {str(e)}")
+    return visa_database
+
+
+def build_visa_store(source_path):
+    snapshot = open_snapshot(source_path)
+    if snapshot is not None and snapshot.is_fresh(source_path):
+        logger.debug(f"Loading {source_path} from compiled snapshot...")
+        return snapshot.to_store()
+    # A stale snapshot still lets compile_visa_database skip the rows it
+    # already covers.
+    visa_database = compile_visa_database(source_path, previous=snapshot)
+    if not isinstance(visa_database, ArrayStore):
+        visa_database = ArrayStore.from_mapping(visa_database)
+    return visa_database
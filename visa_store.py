@@ -0,0 +1,547 @@
+"""Compiled snapshots of the visa database.
+
+Parsing visa_status.ods takes seconds, so the parsed table is also written
+to a small binary snapshot next to the spreadsheet. Every worker can then
+memory-map the snapshot instead of re-parsing the ODS.
+
+Snapshot layout (little endian):
+
+    8 bytes   magic  b"VISADB\\x00\\x00"
+    4 bytes   format version
+    4 bytes   length of the JSON header that follows
+    N bytes   JSON header (source fingerprint, record count, statuses),
+              padded with spaces to an 8 byte boundary
+    8*count   application numbers, sorted, int64
+    1*count   status codes, uint8, indexes into STATUSES
+"""
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+from bisect import bisect_left
+from collections.abc import Mapping
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"VISADB\x00\x00"
+# 2: keys are canonical application numbers (see application_numbers), so
+# snapshots compiled before that are rebuilt.
+# 3: no odd keys in the header; canonical keys are always int64 numbers.
+SNAPSHOT_VERSION = 3
+SNAPSHOT_PREAMBLE = struct.Struct("<8sII")
+
+STATUSES = ("Approved", "Refused")
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
+INT64_MAX = np.iinfo(np.int64).max
+
+
+def snapshot_path_for(source_path):
+    return f"{source_path}.snapshot"
+
+
+def source_fingerprint(source_path):
+    """Size, mtime and content hash identifying one version of the source file."""
+    stat = os.stat(source_path)
+    digest = hashlib.sha256()
+    with open(source_path, "rb") as source:
+        for block in iter(lambda: source.read(1 << 20), b""):
+            digest.update(block)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+
+
+def fingerprint_matches(recorded, source_path):
+    stat = os.stat(source_path)
+    if recorded.get("size") != stat.st_size:
+        return False
+    if recorded.get("mtime_ns") == stat.st_mtime_ns:
+        return True
+    # Same size but touched (e.g. re-copied on deploy): fall back to the hash.
+    return recorded.get("sha256") == source_fingerprint(source_path)["sha256"]
+
+
+def is_integer_key(application_number):
+    """True for strings that round-trip exactly through an int64."""
+    return (
+        application_number.isdigit()
+        and application_number.isascii()
+        and (application_number[0] != "0" or application_number == "0")
+        and (len(application_number) < 19 or int(application_number) <= INT64_MAX)
+    )
+
+
+class ArrayStore(Mapping):
+    """Read-only visa database backed by a sorted int64 array of application
+    numbers and a parallel uint8 array of status codes.
+
+    It answers the same questions as the plain dict load_visa_database used
+    to return (``in``, ``[]``, ``get``, iteration) and hands out the same
+    {"status": ..., "application_date": ...} records, but costs 9 bytes per
+    application instead of a few hundred. Keys are canonical application
+    numbers (see application_numbers), which always fit in an int64.
+    """
+
+    def __init__(self, numbers, codes, statuses=STATUSES):
+        # Native-endian arrays (a no-op view for mmap'd snapshots on x86)
+        # so single lookups can bisect a memoryview in C without paying
+        # numpy's per-call overhead.
+        self.numbers = np.asarray(numbers, dtype=np.int64)
+        self.codes = np.asarray(codes, dtype=np.uint8)
+        self.statuses = tuple(statuses)
+        self._numbers = memoryview(self.numbers)
+        self._codes = memoryview(self.codes)
+
+    @classmethod
+    def from_mapping(cls, visa_database):
+        numbers, codes = [], []
+        for application_number, visa_info in visa_database.items():
+            if not is_integer_key(application_number):
+                raise ValueError(f"Not a canonical application number: {application_number!r}")
+            numbers.append(int(application_number))
+            codes.append(STATUS_CODES[visa_info["status"]])
+
+        numbers = np.asarray(numbers, dtype="<i8")
+        codes = np.asarray(codes, dtype="u1")
+        order = np.argsort(numbers, kind="stable")
+        return cls(numbers[order], codes[order])
+
+    @classmethod
+    def combine(cls, stores):
+        """Merge several stores; for numbers present in more than one, the
+        store listed first wins."""
+        stores = list(stores)
+        if not stores:
+            return cls(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8))
+        statuses = stores[0].statuses
+        if any(store.statuses != statuses for store in stores):
+            raise ValueError("Cannot combine stores with different status tables")
+        numbers = np.concatenate([store.numbers for store in stores])
+        codes = np.concatenate([store.codes for store in stores])
+        # np.unique reports the first occurrence of each number, i.e. the one
+        # from the earliest store.
+        numbers, first = np.unique(numbers, return_index=True)
+        return cls(numbers, codes[first], statuses)
+
+    def __reduce__(self):
+        # memoryviews don't pickle; rebuild them from the arrays instead.
+        return (ArrayStore, (self.numbers, self.codes, self.statuses))
+
+    def _code(self, application_number):
+        if not isinstance(application_number, str) or not is_integer_key(application_number):
+            return None
+        number = int(application_number)
+        index = bisect_left(self._numbers, number)
+        if index < len(self._numbers) and self._numbers[index] == number:
+            return self._codes[index]
+        return None
+
+    def _record(self, code):
+        return {"status": self.statuses[code], "application_date": "2024-01-01"}
+
+    def __getitem__(self, application_number):
+        code = self._code(application_number)
+        if code is None:
+            raise KeyError(application_number)
+        return self._record(code)
+
+    def __contains__(self, application_number):
+        return self._code(application_number) is not None
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __iter__(self):
+        for number in self.numbers.tolist():
+            yield str(number)
+
+    def __reversed__(self):
+        for number in self.numbers[::-1].tolist():
+            yield str(number)
+
+    def lookup_many(self, numbers, default=None):
+        """Status (or default) of each of numbers, an array of canonical
+        application numbers (see application_numbers.canonical_numbers), as
+        an object array, found with one searchsorted over the whole batch."""
+        numbers = np.asarray(numbers, dtype=np.int64).reshape(-1)
+        results = np.full(numbers.shape, default, dtype=object)
+        if len(self.numbers) and len(numbers):
+            positions = np.searchsorted(self.numbers, numbers)
+            positions[positions == len(self.numbers)] = 0
+            found = self.numbers[positions] == numbers
+            statuses = np.asarray(self.statuses, dtype=object)
+            results[found] = statuses[self.codes[positions[found]]]
+        return results
+
+    def merged(self, additions):
+        """A new store with the entries of additions whose numbers are not
+        already present; existing entries win, as earlier rows do in the sheet."""
+        extra = ArrayStore.from_mapping({
+            application_number: visa_info
+            for application_number, visa_info in additions.items()
+            if application_number not in self
+        })
+        positions = np.searchsorted(self.numbers, extra.numbers)
+        return ArrayStore(
+            np.insert(self.numbers, positions, extra.numbers),
+            np.insert(self.codes, positions, extra.codes),
+            self.statuses,
+        )
+
+    @property
+    def nbytes(self):
+        return self.numbers.nbytes + self.codes.nbytes
+
+
+def store_digest(store):
+    """sha256 of an ArrayStore's numbers and statuses, the same for equal
+    content whichever process or generation produced it."""
+    digest = hashlib.sha256(json.dumps(store.statuses).encode())
+    digest.update(np.ascontiguousarray(store.numbers, dtype="<i8").tobytes())
+    digest.update(np.ascontiguousarray(store.codes, dtype="u1").tobytes())
+    return digest.hexdigest()
+
+
+UINT64_MASK = (1 << 64) - 1
+
+
+def _mix64(numbers):
+    """splitmix64's finalizer over a uint64 array; wraps like the C original."""
+    z = numbers + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def _mix64_int(number):
+    """_mix64 for one Python int, without numpy's per-call overhead."""
+    z = (number + 0x9E3779B97F4A7C15) & UINT64_MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & UINT64_MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & UINT64_MASK
+    return z ^ (z >> 31)
+
+
+class BloomFilter:
+    """Bloom filter over the integer application numbers of a store.
+
+    A miss means the number is definitely absent, so lookups for unknown
+    numbers (most of the traffic) can skip the store. Keys that are not
+    plain integers are not in the filter and always count as possible hits.
+    """
+
+    def __init__(self, bits, size, hashes, count):
+        self.bits = np.asarray(bits, dtype=np.uint8)
+        self.size = size
+        self.hashes = hashes
+        self.count = count
+        self._bits = memoryview(self.bits)
+
+    @classmethod
+    def from_numbers(cls, numbers, false_positive_rate=0.01):
+        numbers = np.asarray(numbers, dtype=np.int64)
+        count = len(numbers)
+        size = max(64, math.ceil(-count * math.log(false_positive_rate) / math.log(2) ** 2))
+        hashes = max(1, round(size / max(count, 1) * math.log(2)))
+
+        mixed = _mix64(numbers.astype(np.uint64))
+        h1 = mixed & np.uint64(0xFFFFFFFF)
+        h2 = (mixed >> np.uint64(32)) | np.uint64(1)
+        flags = np.zeros(size, dtype=bool)
+        for i in range(hashes):
+            flags[(h1 + np.uint64(i) * h2) % np.uint64(size)] = True
+        return cls(np.packbits(flags, bitorder="little"), size, hashes, count)
+
+    @classmethod
+    def from_store(cls, visa_database, false_positive_rate=0.01):
+        if isinstance(visa_database, ArrayStore):
+            numbers = visa_database.numbers
+        else:
+            numbers = [int(key) for key in visa_database if is_integer_key(key)]
+        return cls.from_numbers(numbers, false_positive_rate)
+
+    def might_contain(self, application_number):
+        if not isinstance(application_number, str) or not is_integer_key(application_number):
+            return True
+        mixed = _mix64_int(int(application_number))
+        h1, h2 = mixed & 0xFFFFFFFF, (mixed >> 32) | 1
+        bits, size = self._bits, self.size
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    @property
+    def false_positive_rate(self):
+        """Expected rate for a filter of this size holding count numbers."""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class FilteredStore(Mapping):
+    """A store fronted by a BloomFilter, so definite misses never reach it."""
+
+    def __init__(self, store, membership_filter):
+        self.store = store
+        self.filter = membership_filter
+
+    def __getitem__(self, application_number):
+        if not self.filter.might_contain(application_number):
+            raise KeyError(application_number)
+        return self.store[application_number]
+
+    def __contains__(self, application_number):
+        return self.filter.might_contain(application_number) and application_number in self.store
+
+    def lookup_many(self, numbers, default=None):
+        # A batch lookup is already cheaper than probing the filter per key.
+        return lookup_statuses(self.store, numbers, default)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __reversed__(self):
+        return reversed(self.store)
+
+
+class SQLiteStore(Mapping):
+    """Visa database kept in an indexed SQLite file.
+
+    The file is a cache of the published decisions, not a place to keep
+    anything else: sync() rewrites the whole table whenever their content
+    changes, so rows edited in place are lost on the next reload. What it
+    buys over the in-memory stores is that a restart with unchanged
+    decisions reuses the file as it is. The file runs in WAL mode, so
+    readers keep answering while a reload rewrites the table. Each thread
+    gets its own connection, whose statement cache keeps the lookup query
+    prepared.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS decisions ("
+        " application_number TEXT PRIMARY KEY, status TEXT NOT NULL) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID",
+    )
+    LOOKUP = "SELECT status FROM decisions WHERE application_number = ?"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+
+    def _connection(self):
+        # A connection inherited across fork (gunicorn's preload_app opens
+        # one in the master) must not be used; reconnect in each process.
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            # Autocommit; sync() opens its own transaction.
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    @property
+    def generation(self):
+        row = self._connection().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else None
+
+    def sync(self, visa_database, generation):
+        """Replace the table with visa_database in one transaction, unless
+        it already holds exactly that content. Returns True if it wrote
+        anything.
+
+        The skip is keyed on a digest of the content, not on generation:
+        generations restart at 1 whenever the shared snapshot is rebuilt
+        from scratch, so the same number can stand for different tables.
+        """
+        store = visa_database if isinstance(visa_database, ArrayStore) else ArrayStore.from_mapping(visa_database)
+        digest = store_digest(store)
+        statuses = np.asarray(store.statuses, dtype=object)
+        rows = zip(store.numbers.astype(str).tolist(), statuses[store.codes].tolist())
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'digest'").fetchone()
+            written = row is None or row[0] != digest
+            if written:
+                connection.execute("DELETE FROM decisions")
+                connection.executemany("INSERT INTO decisions VALUES (?, ?)", rows)
+                connection.execute("INSERT OR REPLACE INTO meta VALUES ('digest', ?)", (digest,))
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (generation,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if written:
+            logger.info(f"Loaded generation {generation} into {self.path} ({len(self)} records)")
+        return written
+
+    def __getitem__(self, application_number):
+        row = None
+        if isinstance(application_number, str):
+            row = self._connection().execute(self.LOOKUP, (application_number,)).fetchone()
+        if row is None:
+            raise KeyError(application_number)
+        return {"status": row[0], "application_date": "2024-01-01"}
+
+    def __contains__(self, application_number):
+        return (isinstance(application_number, str)
+                and self._connection().execute(self.LOOKUP, (application_number,)).fetchone() is not None)
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM decisions").fetchone()[0]
+
+    def lookup_many(self, numbers, default=None, chunk=500):
+        keys = np.asarray(numbers, dtype=np.int64).reshape(-1).astype(str).tolist()
+        found = {}
+        connection = self._connection()
+        for start in range(0, len(keys), chunk):
+            batch = keys[start:start + chunk]
+            found.update(connection.execute(
+                "SELECT application_number, status FROM decisions WHERE application_number IN"
+                f" ({', '.join('?' * len(batch))})", batch))
+        results = np.empty(len(keys), dtype=object)
+        results[:] = [found.get(key, default) for key in keys]
+        return results
+
+    def __iter__(self):
+        for (application_number,) in self._connection().execute(
+                "SELECT application_number FROM decisions ORDER BY application_number"):
+            yield application_number
+
+    def __reversed__(self):
+        for (application_number,) in self._connection().execute(
+                "SELECT application_number FROM decisions ORDER BY application_number DESC"):
+            yield application_number
+
+
+def lookup_statuses(visa_database, numbers, default=None):
+    """Status of each of numbers, canonical application numbers, in
+    visa_database, default where it has no record, as an object array.
+    Stores with a batch lookup do the whole array at once; any other
+    mapping is asked key by key."""
+    if hasattr(visa_database, "lookup_many"):
+        return visa_database.lookup_many(numbers, default)
+    results = np.full(len(numbers), default, dtype=object)
+    for index, number in enumerate(np.asarray(numbers).tolist()):
+        visa_info = visa_database.get(str(number))
+        if visa_info is not None:
+            results[index] = visa_info["status"]
+    return results
+
+
+def write_snapshot(visa_database, snapshot_path, fingerprint, watermark=None, generation=0):
+    """Atomically write visa_database (number -> {"status": ...}) as a snapshot.
+
+    watermark is the reader's note of how far the source was parsed, kept so
+    a later ingest of the grown file can resume from it. generation numbers
+    successive versions of a snapshot shared between processes.
+    """
+    store = visa_database if isinstance(visa_database, ArrayStore) else ArrayStore.from_mapping(visa_database)
+    numbers = np.ascontiguousarray(store.numbers, dtype="<i8")
+    codes = np.ascontiguousarray(store.codes, dtype="u1")
+
+    header = json.dumps({
+        "source": fingerprint,
+        "count": len(numbers),
+        "statuses": store.statuses,
+        "watermark": watermark,
+        "generation": generation,
+    }).encode()
+    header += b" " * (-(SNAPSHOT_PREAMBLE.size + len(header)) % 8)
+
+    directory = os.path.dirname(os.path.abspath(snapshot_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".visa-snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as snapshot:
+            snapshot.write(SNAPSHOT_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)))
+            snapshot.write(header)
+            snapshot.write(numbers.tobytes())
+            snapshot.write(codes.tobytes())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, snapshot_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    logger.info(f"Wrote visa snapshot {snapshot_path} ({len(store)} records)")
+
+
+class Snapshot:
+    """A memory-mapped snapshot: sorted int64 numbers plus parallel status codes."""
+
+    def __init__(self, path):
+        with open(path, "rb") as snapshot:
+            self._mmap = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_len = SNAPSHOT_PREAMBLE.unpack_from(self._mmap)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} visa snapshot")
+        offset = SNAPSHOT_PREAMBLE.size
+        self.header = json.loads(self._mmap[offset:offset + header_len])
+        offset += header_len
+        count = self.header["count"]
+        self.numbers = np.frombuffer(self._mmap, dtype="<i8", count=count, offset=offset)
+        self.codes = np.frombuffer(self._mmap, dtype="u1", count=count, offset=offset + 8 * count)
+        self.statuses = tuple(self.header["statuses"])
+        self.watermark = self.header.get("watermark")
+        self.generation = self.header.get("generation", 0)
+
+    def is_fresh(self, source_path):
+        return fingerprint_matches(self.header["source"], source_path)
+
+    def to_store(self):
+        """An ArrayStore reading straight from the mapped file."""
+        return ArrayStore(self.numbers, self.codes, self.statuses)
+
+
+def open_snapshot(source_path, snapshot_path=None):
+    """Return the Snapshot for source_path, fresh or not, or None if there is no usable one."""
+    return read_snapshot(snapshot_path or snapshot_path_for(source_path))
+
+
+def read_snapshot(snapshot_path):
+    if not os.path.exists(snapshot_path):
+        return None
+    try:
+        return Snapshot(snapshot_path)
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        logger.warning(f"Ignoring unreadable visa snapshot {snapshot_path}: {e}")
+        return None
+
+
+def diff_databases(old, new):
+    """Application numbers added, removed and whose status changed between two stores."""
+    old = old.store if isinstance(old, FilteredStore) else old
+    new = new.store if isinstance(new, FilteredStore) else new
+    if isinstance(old, ArrayStore) and isinstance(new, ArrayStore):
+        common, old_index, new_index = np.intersect1d(
+            old.numbers, new.numbers, assume_unique=True, return_indices=True)
+        old_statuses = np.asarray(old.statuses, dtype=object)[old.codes[old_index]]
+        new_statuses = np.asarray(new.statuses, dtype=object)[new.codes[new_index]]
+        return {
+            "added": np.setdiff1d(new.numbers, common, assume_unique=True).astype(str).tolist(),
+            "removed": np.setdiff1d(old.numbers, common, assume_unique=True).astype(str).tolist(),
+            "changed": common[old_statuses != new_statuses].astype(str).tolist(),
+        }
+
+    return {
+        "added": [key for key in new if key not in old],
+        "removed": [key for key in old if key not in new],
+        "changed": [key for key in new if key in old and old[key]["status"] != new[key]["status"]],
+    }
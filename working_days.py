@@ -0,0 +1,164 @@
+"""Working days between two dates, in constant time.
+
+Weekdays are counted in closed form from date ordinals. Public holidays and
+office closures come from a table built once per calendar: for every day
+in the covered years it holds how many non-working weekdays fall before
+it, so the holidays inside any range are one subtraction away.
+"""
+from datetime import date, timedelta
+
+import numpy as np
+
+FIRST_YEAR = 1990
+LAST_YEAR = 2100
+
+
+def easter_sunday(year):
+    """Western Easter, by the anonymous Gregorian algorithm."""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def _first_monday(year, month):
+    first = date(year, month, 1)
+    return first + timedelta(days=-first.weekday() % 7)
+
+
+def _last_monday(year, month):
+    last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=last.weekday())
+
+
+def irish_public_holidays(year):
+    """Days the Irish public service is closed in year.
+
+    A holiday that falls on a weekend is observed on the next weekday that
+    is not already a holiday, as the public service does (Christmas on a
+    Saturday moves to Monday and St Stephen's Day to Tuesday).
+    """
+    holidays = [
+        date(year, 1, 1),
+        date(year, 3, 17),
+        easter_sunday(year) + timedelta(days=1),
+        _first_monday(year, 5),
+        _first_monday(year, 6),
+        _first_monday(year, 8),
+        _last_monday(year, 10),
+        date(year, 12, 25),
+        date(year, 12, 26),
+    ]
+    if year >= 2023:
+        # St Brigid's Day: 1 February when that is a Friday, otherwise the
+        # first Monday in February.
+        brigid = date(year, 2, 1)
+        holidays.append(brigid if brigid.weekday() == 4 else _first_monday(year, 2))
+    if year == 2022:
+        holidays.append(date(2022, 3, 18))
+
+    observed = set()
+    for holiday in sorted(holidays):
+        while holiday.weekday() >= 5 or holiday in observed:
+            holiday += timedelta(days=1)
+        observed.add(holiday)
+    return sorted(observed)
+
+
+def parse_closures(spec):
+    """Dates from a comma separated list of YYYY-MM-DD days and
+    YYYY-MM-DD..YYYY-MM-DD inclusive ranges."""
+    closures = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        first, _, last = item.partition("..")
+        first = date.fromisoformat(first)
+        last = date.fromisoformat(last) if last else first
+        closures.extend(first + timedelta(days=offset) for offset in range((last - first).days + 1))
+    return closures
+
+
+# date ordinal of numpy's day 0, 1970-01-01
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def _weekdays_before(ordinal):
+    """Weekdays among date ordinals 1 .. ordinal - 1 (ordinal 1 is a Monday)."""
+    weeks, days = divmod(ordinal - 1, 7)
+    return weeks * 5 + min(days, 5)
+
+
+def _weekdays_before_many(ordinals):
+    weeks, days = np.divmod(ordinals - 1, 7)
+    return weeks * 5 + np.minimum(days, 5)
+
+
+def _ordinals(days):
+    """Date ordinals of anything np.asarray can turn into datetime64 days:
+    dates, datetimes, YYYY-MM-DD strings or datetime64 arrays."""
+    return np.asarray(days, dtype="datetime64[D]").astype(np.int64) + EPOCH_ORDINAL
+
+
+class WorkingDayCalendar:
+    """Counts working days: weekdays that are not a holiday or closure.
+
+    Only days between first_year and last_year are looked up in the
+    holiday table; ranges reaching beyond it count the weekdays outside
+    as working days.
+    """
+
+    def __init__(self, closed_days=(), first_year=FIRST_YEAR, last_year=LAST_YEAR):
+        self.first_ordinal = date(first_year, 1, 1).toordinal()
+        self.last_ordinal = date(last_year, 12, 31).toordinal()
+        offsets = sorted({day.toordinal() - self.first_ordinal for day in closed_days
+                          if day.weekday() < 5 and self.first_ordinal <= day.toordinal() <= self.last_ordinal})
+        # closed_before[i]: closed weekdays among the table's first i days.
+        closed = np.zeros(self.last_ordinal - self.first_ordinal + 1, dtype=np.int32)
+        closed[offsets] = 1
+        self.closed_before = np.concatenate(([0], np.cumsum(closed, dtype=np.int32)))
+
+    @classmethod
+    def ireland(cls, closures=(), first_year=FIRST_YEAR, last_year=LAST_YEAR):
+        holidays = [holiday for year in range(first_year, last_year + 1) for holiday in irish_public_holidays(year)]
+        return cls(holidays + list(closures), first_year, last_year)
+
+    def _closed_before(self, ordinal):
+        index = min(max(ordinal - self.first_ordinal, 0), len(self.closed_before) - 1)
+        return int(self.closed_before[index])
+
+    def count(self, start, end):
+        """Working days from start's date to end, both ends included.
+
+        start and end are both dates or both datetimes; with datetimes the
+        range covers whole days from start up to end, so end's own date
+        only counts once its time of day has passed start's.
+        """
+        days = (end - start).days
+        if days < 0:
+            return 0
+        first = start.toordinal()
+        last = first + days
+        weekdays = _weekdays_before(last + 1) - _weekdays_before(first)
+        return weekdays - (self._closed_before(last + 1) - self._closed_before(first))
+
+    def count_many(self, starts, end):
+        """count() for many ranges in one pass, as an int64 array.
+
+        starts is a sequence or array of start days and end one end day or
+        an array matching starts. Times of day are dropped, so each range
+        covers start's date to end's date inclusive; starts must not be NaT.
+        """
+        first = _ordinals(starts)
+        last = _ordinals(end)
+        last, first = np.broadcast_arrays(last, first)
+        weekdays = _weekdays_before_many(last + 1) - _weekdays_before_many(first)
+        upper = len(self.closed_before) - 1
+        closed = (self.closed_before[np.clip(last + 1 - self.first_ordinal, 0, upper)]
+                  - self.closed_before[np.clip(first - self.first_ordinal, 0, upper)])
+        return np.where(last >= first, weekdays - closed, 0)